@@ -1,33 +1,129 @@
 from flask import Flask, request
-from twilio.twiml.messaging_response import MessagingResponse
-import firebase_admin
-from firebase_admin import credentials, firestore, storage
-import requests
+from twilio.rest import Client
+from firebase_admin import credentials
+from google.cloud import firestore, storage
 from requests.auth import HTTPBasicAuth
 import os
-from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv()
+from concurrent.futures import ThreadPoolExecutor
+from clients import ProcessLocal, pooled_session
+from conversation import flow, ingest_report
+from document_index import DocumentIndex
+from ingest import IngestQueue, QueueFull
+from media import spool_media
+from metrics import profiler_from_env, state_label
+from webhook import (MEDIA_CHUNK_SIZE, MEDIA_FETCH_WORKERS, MEDIA_MAX_BYTES, MEDIA_SPOOL_BYTES,
+                     TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, TWILIO_WHATSAPP_NUMBER, answer,
+                     content_stats, document_index_options, ingest_queue_options, mark_saved,
+                     metrics, new_job, pending_media, reply_already_queued, reply_busy,
+                     reply_document, reply_documents, reply_queued, settle,
+                     state_store_from_env, store_media, write_batch)
 
 app = Flask(__name__)
+profiler = profiler_from_env()
+
+# Clients are created per process on first use (see warmup()), so gunicorn
+# workers never share gRPC channels or sockets inherited from the master.
+cred = ProcessLocal(lambda: credentials.Certificate(os.getenv('FIREBASE_CREDENTIALS_PATH')))
+db = ProcessLocal(lambda: firestore.Client(
+    credentials=cred.get_credential(), project=cred.project_id))
+bucket = ProcessLocal(lambda: storage.Client(
+    credentials=cred.get_credential(), project=cred.project_id
+).bucket(os.getenv('FIREBASE_STORAGE_BUCKET')))
+twilio_client = ProcessLocal(lambda: Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN))
+media_session = ProcessLocal(lambda: pooled_session(
+    auth=HTTPBasicAuth(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN),
+    pool_size=int(os.getenv('HTTP_POOL_SIZE', 10))
+))
+media_executor = ProcessLocal(lambda: ThreadPoolExecutor(
+    max_workers=MEDIA_FETCH_WORKERS, thread_name_prefix='media'
+))
+state_store = state_store_from_env()
+document_index = DocumentIndex(db, versions=state_store, **document_index_options())
+
+def warmup():
+    """Open this worker's client channels before the first webhook arrives."""
+    media_session.get()
+    twilio_client.get()
+    bucket.get()
+    try:
+        # One tiny read forces credential loading and the gRPC handshake.
+        list(db.collection('documents').limit(1).stream())
+    except Exception:
+        app.logger.exception("Firestore warmup failed")
+
+@metrics.timed('twilio_send')
+def send_message(to_number, body):
+    twilio_client.messages.create(from_=TWILIO_WHATSAPP_NUMBER, to=to_number, body=body)
+
+def upload_media(job, media):
+    """Store one attachment; returns its record, or None for a duplicate."""
+    with metrics.timer('media_download'):
+        spool, size, digest = spool_media(media['url'], None,
+                                          chunk_size=MEDIA_CHUNK_SIZE, max_bytes=MEDIA_MAX_BYTES,
+                                          spool_bytes=MEDIA_SPOOL_BYTES, session=media_session.get())
+    with spool:
+        with metrics.timer('dedup_lookup'):
+            duplicate = document_index.find_by_hash(job['from_number'], job['doc_type'], digest)
+        if duplicate:
+            content_stats.record_duplicate(size)
+            return None
+        return store_media(bucket, job, media, spool, size, digest)
+
+def ingest_document(job):
+    pending = pending_media(job)
+    futures = [media_executor.submit(upload_media, job, media) for _, media in pending]
+    outcomes = []
+    for future in futures:
+        try:
+            outcomes.append(future.result())
+        except Exception as exc:
+            outcomes.append(exc)
+
+    records, error = settle(job, pending, outcomes)
+    if records:
+        with metrics.timer('firestore_batch_commit'):
+            write_batch(db, job, records).commit()
+        mark_saved(job, records)
+        document_index.invalidate(job['from_number'])
+    if error is not None:
+        raise error
+
+def ingest_settled(job, result):
+    send_message(job['from_number'], ingest_report(job, MEDIA_MAX_BYTES))
+
+ingest_queue = IngestQueue(ingest_document, on_success=ingest_settled, on_failure=ingest_settled,
+                           **ingest_queue_options())
+
+metrics.add_collector('whatsapp_document_cache', document_index.stats)
+metrics.add_collector('whatsapp_content', content_stats.stats)
+metrics.add_collector('whatsapp_ingest', lambda: {'queue_depth': ingest_queue.depth()})
+
+@flow.action('show_all_documents')
+def show_all_documents(turn):
+    with metrics.timer('firestore_query', state_label(turn.state)):
+        documents = document_index.all_for(turn.from_number)
+    reply_documents(turn, documents)
+
+@flow.action('receive_document')
+def receive_document(turn, doc_type):
+    with metrics.timer('firestore_query', state_label(turn.state)):
+        document = document_index.first_of_type(turn.from_number, doc_type)
+    reply_document(turn, doc_type, document)
+
+@flow.action('queue_document')
+def queue_document(turn):
+    job = new_job(turn)
+    try:
+        with metrics.timer('ingest_enqueue', state_label(turn.state)):
+            accepted = ingest_queue.submit(job)
+    except QueueFull:
+        return reply_busy(turn, job)
+    if accepted:
+        reply_queued(turn, job)
+    else:
+        reply_already_queued(turn, job, ingest_queue.status(job['message_sid']))
 
-# Initialize Firebase
-cred_path = os.getenv('FIREBASE_CREDENTIALS_PATH')
-cred = credentials.Certificate(cred_path)
-firebase_admin.initialize_app(cred, {
-    'storageBucket': os.getenv('FIREBASE_STORAGE_BUCKET')
-})
-
-# Initialize Firestore and Storage
-db = firestore.client()
-bucket = storage.bucket()
-
-user_state = {}
-
-def download_media(media_url, auth):
-    response = requests.get(media_url, auth=auth)
-    return response.content if response.status_code == 200 else None
+flow.check_actions()
 
 @app.route("/whatsapp", methods=['POST'])
 def whatsapp():
@@ -35,138 +131,13 @@ def whatsapp():
     num_media = int(request.values.get('NumMedia', 0))
     from_number = request.values.get('From', '')
 
-    resp = MessagingResponse()
-    msg = resp.message()
-
-    state = user_state.get(from_number, 'greeting')
-
-    if state == 'greeting':
-        msg.body("Hello! How can I assist you?\n\n" +
-                 "1. Send docs\n" +
-                 "2. Receive docs\n" +
-                 "3. Show all documents\n" +
-                 "4. End chat")
-        user_state[from_number] = 'waiting_for_action'
-
-    elif state == 'waiting_for_action':
-        if incoming_msg == '1':
-            msg.body("Which document do you want to send?\n\n" +
-                     "1. Aadhar Card\n" +
-                     "2. PAN Card\n" +
-                     "3. Form 16\n" +
-                     "4. Bank Statement\n" +
-                     "5. Capital Gain Statement\n" +
-                     "6. House Property Documents\n" +
-                     "7. Other Documents")
-            user_state[from_number] = 'waiting_for_document_type'
-        elif incoming_msg == '2':
-            msg.body("Which document do you want to receive?\n\n" +
-                     "1. Aadhar Card\n" +
-                     "2. PAN Card\n" +
-                     "3. ITR Related Docs")
-            user_state[from_number] = 'waiting_for_receive_document_type'
-        elif incoming_msg == '3':
-            msg.body("Showing all documents...")
-            documents = db.collection('documents').where('user', '==', from_number).stream()
-            for doc in documents:
-                document = doc.to_dict()
-                msg.body(f"{document['type']}: {document['url']}")
-            user_state.pop(from_number, None)
-        elif incoming_msg == '4':
-            msg.body("Chat ended. You can start over by sending any message.")
-            user_state.pop(from_number, None)
-        else:
-            msg.body("Please choose an option:\n" +
-                     "1. Send docs\n" +
-                     "2. Receive docs\n" +
-                     "3. Show all documents\n" +
-                     "4. End chat")
-
-    elif state == 'waiting_for_document_type':
-        doc_types = {
-            '1': 'Aadhar Card', '2': 'PAN Card', '3': 'Form 16', '4': 'Bank Statement',
-            '5': 'Capital Gain Statement', '6': 'House Property Documents', '7': 'Other Documents'
-        }
-        doc_type = doc_types.get(incoming_msg)
-        if doc_type:
-            user_state[from_number] = {'state': 'waiting_for_document', 'doc_type': doc_type}
-            msg.body(f"Please send the {doc_type} now.")
-        elif incoming_msg == '4':
-            msg.body("Chat ended. You can start over by sending any message.")
-            user_state.pop(from_number, None)
-        else:
-            msg.body("Invalid option. Please choose again:\n" +
-                     "1. Aadhar Card\n" +
-                     "2. PAN Card\n" +
-                     "3. Form 16\n" +
-                     "4. Bank Statement\n" +
-                     "5. Capital Gain Statement\n" +
-                     "6. House Property Documents\n" +
-                     "7. Other Documents")
-
-    elif state == 'waiting_for_receive_document_type':
-        doc_types = {'1': 'Aadhar Card', '2': 'PAN Card', '3': 'ITR Related Docs'}
-        doc_type = doc_types.get(incoming_msg)
-        if doc_type:
-            documents = db.collection('documents').where('type', '==', doc_type).where('user', '==', from_number).stream()
-            document_found = False
-            for doc in documents:
-                document = doc.to_dict()
-                msg.body(f"Here is your {doc_type}: {document['url']}")
-                document_found = True
-                break
-            if not document_found:
-                msg.body(f"No {doc_type} found.")
-            user_state.pop(from_number, None)
-        elif incoming_msg == '4':
-            msg.body("Chat ended. You can start over by sending any message.")
-            user_state.pop(from_number, None)
-        else:
-            msg.body("Invalid option. Please choose again:\n" +
-                     "1. Aadhar Card\n" +
-                     "2. PAN Card\n" +
-                     "3. ITR Related Docs")
-
-    elif isinstance(state, dict) and state.get('state') == 'waiting_for_document':
-        if num_media > 0:
-            media_url = request.values['MediaUrl0']
-            media_content_type = request.values['MediaContentType0']
-            media_extension = media_content_type.split('/')[-1]
-            media_sid = request.values['MessageSid']
-            doc_type = state['doc_type']
-
-            account_sid = os.getenv('TWILIO_ACCOUNT_SID')
-            auth_token = os.getenv('TWILIO_AUTH_TOKEN')
-            auth = HTTPBasicAuth(account_sid, auth_token)
-            media_data = download_media(media_url, auth)
-
-            if media_data:
-                filename = f"{doc_type.replace(' ', '_').lower()}_{media_sid}.{media_extension}"
-                blob = bucket.blob(f"documents/{filename}")
-                blob.upload_from_string(media_data, content_type=media_content_type)
-                blob.make_public()
-
-                db.collection('documents').add({
-                    'filename': filename,
-                    'content_type': media_content_type,
-                    'url': blob.public_url,
-                    'type': doc_type,
-                    'user': from_number
-                })
-                msg.body(f"{doc_type} received and saved.")
-                user_state.pop(from_number, None)
-            else:
-                msg.body("Failed to download media.")
-        elif incoming_msg == '4':
-            msg.body("Chat ended. You can start over by sending any message.")
-            user_state.pop(from_number, None)
-        else:
-            msg.body("Please send a document as media. To end the chat, reply with '4'.")
-
-    else:
-        msg.body("An error occurred. Please start over.")
+    with profiler.sample('whatsapp'), metrics.request('whatsapp') as trace:
+        return answer(flow, state_store, trace, from_number, incoming_msg, num_media > 0,
+                      request.values)
 
-    return str(resp)
+@app.route("/metrics")
+def metrics_endpoint():
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
 
 @app.errorhandler(404)
 def page_not_found(e):
@@ -0,0 +1,206 @@
+"""aiohttp version of the /whatsapp webhook.
+
+Serves the same TwiML contract as app.py without blocking on I/O: Twilio
+media is fetched on a pooled aiohttp session, Firestore goes through its
+AsyncClient, and the blocking Cloud Storage calls run on a bounded thread
+pool. Spool writes and a SQLite state store are also kept off the event
+loop. Run it with
+
+    gunicorn async_app:create_app --worker-class aiohttp.GunicornWebWorker
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import firebase_admin
+from aiohttp import web
+from firebase_admin import credentials, firestore_async, storage
+from twilio.http.async_http_client import AsyncTwilioHttpClient
+from twilio.rest import Client
+
+from conversation import build_flow, ingest_report
+from document_index import AsyncDocumentIndex
+from ingest import AsyncIngestQueue, QueueFull
+from media import fetch_media_async
+from metrics import state_label
+from webhook import (MEDIA_CHUNK_SIZE, MEDIA_FETCH_WORKERS, MEDIA_MAX_BYTES, MEDIA_SPOOL_BYTES,
+                     TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, TWILIO_WHATSAPP_NUMBER, answer_async,
+                     content_stats, document_index_options, ingest_queue_options, mark_saved,
+                     metrics, new_job, pending_media, reply_already_queued, reply_busy,
+                     reply_document, reply_documents, reply_queued, settle,
+                     state_store_from_env, store_media, write_batch)
+
+logger = logging.getLogger(__name__)
+
+http_key = web.AppKey('http', aiohttp.ClientSession)
+storage_executor_key = web.AppKey('storage_executor', ThreadPoolExecutor)
+ingest_queue_key = web.AppKey('ingest_queue', AsyncIngestQueue)
+twilio_key = web.AppKey('twilio', Client)
+
+
+def initialize_firebase():
+    try:
+        return firebase_admin.get_app()
+    except ValueError:
+        cred = credentials.Certificate(os.getenv('FIREBASE_CREDENTIALS_PATH'))
+        return firebase_admin.initialize_app(cred, {
+            'storageBucket': os.getenv('FIREBASE_STORAGE_BUCKET')
+        })
+
+
+async def create_app(db=None, bucket=None, twilio=None):
+    """Build the aiohttp app; the clients default to the Firebase app's."""
+    if db is None or bucket is None:
+        initialize_firebase()
+    db = db if db is not None else firestore_async.client()
+    bucket = bucket if bucket is not None else storage.bucket()
+    state_store = state_store_from_env()
+    document_index = AsyncDocumentIndex(db, versions=state_store, **document_index_options())
+    twilio_auth = aiohttp.BasicAuth(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+    flow = build_flow()
+    if float(os.getenv('PROFILE_SAMPLE_RATE', 0.0)):
+        # cProfile hooks the whole thread, which every request here shares.
+        logger.warning("PROFILE_SAMPLE_RATE is ignored by the aiohttp app")
+    metrics.add_collector('whatsapp_document_cache', document_index.stats)
+    metrics.add_collector('whatsapp_content', content_stats.stats)
+    app = web.Application(middlewares=[not_found])
+
+    async def send_message(to_number, body):
+        with metrics.timer('twilio_send'):
+            await app[twilio_key].messages.create_async(
+                from_=TWILIO_WHATSAPP_NUMBER, to=to_number, body=body)
+
+    media_slots = asyncio.Semaphore(MEDIA_FETCH_WORKERS)
+
+    async def upload_media(job, media):
+        async with media_slots:
+            with tempfile.SpooledTemporaryFile(max_size=MEDIA_SPOOL_BYTES) as spool:
+                hasher = hashlib.sha256()
+                with metrics.timer('media_download'):
+                    size = await fetch_media_async(app[http_key], media['url'], twilio_auth, spool,
+                                                   chunk_size=MEDIA_CHUNK_SIZE,
+                                                   max_bytes=MEDIA_MAX_BYTES, hasher=hasher,
+                                                   executor=app[storage_executor_key])
+                spool.seek(0)
+                digest = hasher.hexdigest()
+                with metrics.timer('dedup_lookup'):
+                    duplicate = await document_index.find_by_hash(
+                        job['from_number'], job['doc_type'], digest)
+                if duplicate:
+                    content_stats.record_duplicate(size)
+                    return None
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(app[storage_executor_key], store_media,
+                                                  bucket, job, media, spool, size, digest)
+
+    async def ingest_document(job):
+        pending = pending_media(job)
+        outcomes = await asyncio.gather(
+            *(upload_media(job, media) for _, media in pending),
+            return_exceptions=True
+        )
+
+        records, error = settle(job, pending, outcomes)
+        if records:
+            with metrics.timer('firestore_batch_commit'):
+                await write_batch(db, job, records).commit()
+            mark_saved(job, records)
+            await document_index.invalidate(job['from_number'])
+        if error is not None:
+            raise error
+
+    async def ingest_settled(job, result):
+        await send_message(job['from_number'], ingest_report(job, MEDIA_MAX_BYTES))
+
+    @flow.action('show_all_documents')
+    async def show_all_documents(turn):
+        with metrics.timer('firestore_query', state_label(turn.state)):
+            documents = await document_index.all_for(turn.from_number)
+        reply_documents(turn, documents)
+
+    @flow.action('receive_document')
+    async def receive_document(turn, doc_type):
+        with metrics.timer('firestore_query', state_label(turn.state)):
+            document = await document_index.first_of_type(turn.from_number, doc_type)
+        reply_document(turn, doc_type, document)
+
+    @flow.action('queue_document')
+    async def queue_document(turn):
+        job = new_job(turn)
+        try:
+            with metrics.timer('ingest_enqueue', state_label(turn.state)):
+                accepted = await app[ingest_queue_key].submit(job)
+        except QueueFull:
+            return reply_busy(turn, job)
+        if accepted:
+            reply_queued(turn, job)
+        else:
+            status = await app[ingest_queue_key].status(job['message_sid'])
+            reply_already_queued(turn, job, status)
+
+    flow.check_actions()
+
+    async def whatsapp(request):
+        values = await request.post()
+        incoming_msg = values.get('Body', '').lower().strip()
+        num_media = int(values.get('NumMedia', 0))
+        from_number = values.get('From', '')
+
+        with metrics.request('whatsapp') as trace:
+            body = await answer_async(flow, state_store, trace, from_number, incoming_msg,
+                                      num_media > 0, values)
+        return web.Response(text=body, content_type='text/html')
+
+    async def metrics_endpoint(request):
+        # Reads the other workers' snapshots from disk.
+        text = await asyncio.to_thread(metrics.render)
+        return web.Response(text=text, content_type='text/plain', charset='utf-8')
+
+    async def start_clients(app):
+        connector = aiohttp.TCPConnector(limit=int(os.getenv('HTTP_POOL_SIZE', 100)),
+                                         keepalive_timeout=30)
+        app[http_key] = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=None, connect=5, sock_read=30)
+        )
+        app[twilio_key] = twilio if twilio is not None else Client(
+            TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, http_client=AsyncTwilioHttpClient())
+        app[storage_executor_key] = ThreadPoolExecutor(
+            max_workers=int(os.getenv('STORAGE_EXECUTOR_WORKERS', 8)),
+            thread_name_prefix='storage'
+        )
+        app[ingest_queue_key] = AsyncIngestQueue(
+            ingest_document, on_success=ingest_settled, on_failure=ingest_settled,
+            **ingest_queue_options()
+        )
+        app[ingest_queue_key].start()
+        metrics.add_collector('whatsapp_ingest',
+                              lambda: {'queue_depth': app[ingest_queue_key].depth()})
+
+    async def close_clients(app):
+        await app[ingest_queue_key].stop()
+        await app[http_key].close()
+        await app[twilio_key].http_client.close()
+        app[storage_executor_key].shutdown(wait=True)
+
+    app.router.add_post('/whatsapp', whatsapp)
+    app.router.add_get('/metrics', metrics_endpoint)
+    app.on_startup.append(start_clients)
+    app.on_cleanup.append(close_clients)
+    return app
+
+
+@web.middleware
+async def not_found(request, handler):
+    try:
+        return await handler(request)
+    except web.HTTPNotFound:
+        return web.Response(text="Page not found", status=404)
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), port=int(os.getenv('PORT', 5000)))
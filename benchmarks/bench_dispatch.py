@@ -0,0 +1,168 @@
+"""Per-message dispatch cost: compiled flow engine vs the old if/elif chain.
+
+Both sides only build reply bodies; actions that hit Firestore or the
+ingestion queue are replaced with no-ops.
+
+    python benchmarks/bench_dispatch.py --messages 200000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from conversation import build_flow  # noqa: E402
+
+
+def legacy_dispatch(state, incoming_msg, num_media, reply):
+    """The pre-engine handler body, minus its I/O."""
+    if state == 'greeting':
+        reply("Hello! How can I assist you?\n\n" +
+              "1. Send docs\n" +
+              "2. Receive docs\n" +
+              "3. Show all documents\n" +
+              "4. End chat")
+        return 'waiting_for_action'
+    elif state == 'waiting_for_action':
+        if incoming_msg == '1':
+            reply("Which document do you want to send?\n\n" +
+                  "1. Aadhar Card\n" +
+                  "2. PAN Card\n" +
+                  "3. Form 16\n" +
+                  "4. Bank Statement\n" +
+                  "5. Capital Gain Statement\n" +
+                  "6. House Property Documents\n" +
+                  "7. Other Documents")
+            return 'waiting_for_document_type'
+        elif incoming_msg == '2':
+            reply("Which document do you want to receive?\n\n" +
+                  "1. Aadhar Card\n" +
+                  "2. PAN Card\n" +
+                  "3. ITR Related Docs")
+            return 'waiting_for_receive_document_type'
+        elif incoming_msg == '3':
+            reply("Showing all documents...")
+            return None
+        elif incoming_msg == '4':
+            reply("Chat ended. You can start over by sending any message.")
+            return None
+        else:
+            reply("Please choose an option:\n" +
+                  "1. Send docs\n" +
+                  "2. Receive docs\n" +
+                  "3. Show all documents\n" +
+                  "4. End chat")
+            return state
+    elif state == 'waiting_for_document_type':
+        doc_types = {
+            '1': 'Aadhar Card', '2': 'PAN Card', '3': 'Form 16', '4': 'Bank Statement',
+            '5': 'Capital Gain Statement', '6': 'House Property Documents', '7': 'Other Documents'
+        }
+        doc_type = doc_types.get(incoming_msg)
+        if doc_type:
+            reply(f"Please send the {doc_type} now.")
+            return {'state': 'waiting_for_document', 'doc_type': doc_type}
+        elif incoming_msg == '4':
+            reply("Chat ended. You can start over by sending any message.")
+            return None
+        else:
+            reply("Invalid option. Please choose again:\n" +
+                  "1. Aadhar Card\n" +
+                  "2. PAN Card\n" +
+                  "3. Form 16\n" +
+                  "4. Bank Statement\n" +
+                  "5. Capital Gain Statement\n" +
+                  "6. House Property Documents\n" +
+                  "7. Other Documents")
+            return state
+    elif state == 'waiting_for_receive_document_type':
+        doc_types = {'1': 'Aadhar Card', '2': 'PAN Card', '3': 'ITR Related Docs'}
+        doc_type = doc_types.get(incoming_msg)
+        if doc_type:
+            return None
+        elif incoming_msg == '4':
+            reply("Chat ended. You can start over by sending any message.")
+            return None
+        else:
+            reply("Invalid option. Please choose again:\n" +
+                  "1. Aadhar Card\n" +
+                  "2. PAN Card\n" +
+                  "3. ITR Related Docs")
+            return state
+    elif isinstance(state, dict) and state.get('state') == 'waiting_for_document':
+        if num_media > 0:
+            return None
+        elif incoming_msg == '4':
+            reply("Chat ended. You can start over by sending any message.")
+            return None
+        else:
+            reply("Please send a document as media. To end the chat, reply with '4'.")
+            return state
+    else:
+        reply("An error occurred. Please start over.")
+        return state
+
+
+def build_engine():
+    engine = build_flow()
+    for name in ('show_all_documents', 'receive_document', 'queue_document'):
+        engine.action(name)(lambda turn, **params: None)
+    return engine
+
+
+def make_workload(n, seed=0):
+    rng = random.Random(seed)
+    states = ['greeting', 'waiting_for_action', 'waiting_for_document_type',
+              'waiting_for_receive_document_type',
+              {'state': 'waiting_for_document', 'doc_type': 'PAN Card'}]
+    inputs = ['hi', '1', '2', '3', '4', '5', '7', '9', 'menu']
+    return [(rng.choice(states), rng.choice(inputs), rng.choice((0, 0, 1)))
+            for _ in range(n)]
+
+
+def check_equivalent(engine, workload):
+    for state, text, num_media in workload:
+        old, new = [], []
+        old_next = legacy_dispatch(state, text, num_media, old.append)
+        new_next = engine.dispatch(state, text, num_media > 0, new.append,
+                                   from_number='whatsapp:+10000000000', values={})
+        assert (old, old_next) == (new, new_next), (state, text, num_media, old, new)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=200000)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    engine = build_engine()
+    compile_time = time.perf_counter() - start
+
+    workload = make_workload(args.messages)
+    check_equivalent(engine, workload[:5000])
+
+    replies = []
+    sink = replies.append
+
+    start = time.perf_counter()
+    for state, text, num_media in workload:
+        legacy_dispatch(state, text, num_media, sink)
+    legacy = time.perf_counter() - start
+    replies.clear()
+
+    start = time.perf_counter()
+    for state, text, num_media in workload:
+        engine.dispatch(state, text, num_media > 0, sink,
+                        from_number='whatsapp:+10000000000', values=None)
+    compiled = time.perf_counter() - start
+
+    n = len(workload)
+    print(f"compile: {compile_time * 1e3:.2f} ms")
+    print(f"legacy:  {legacy / n * 1e9:8.0f} ns/message")
+    print(f"engine:  {compiled / n * 1e9:8.0f} ns/message")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Firestore reads and latency for "Show all" / "Receive docs", cached vs not.
+
+Replays a random mix of lookups and uploads against a fake Firestore that
+sleeps `--latency-ms` per round trip.
+
+    python benchmarks/bench_document_index.py --users 50 --lookups 2000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from benchmarks.fakes import FakeFirestore  # noqa: E402
+from conversation import MENUS  # noqa: E402
+from document_index import DocumentIndex  # noqa: E402
+
+
+def seed(db, users, docs_per_user, rng):
+    for user in users:
+        for i in range(docs_per_user):
+            db.collection('documents').add({
+                'filename': f"doc_{i}.pdf", 'content_type': 'application/pdf',
+                'url': f"https://storage.example/{user}/{i}",
+                'type': rng.choice(MENUS['send']), 'user': user, 'created': float(i),
+            })
+
+
+def uncached_all(db, user):
+    return [doc.to_dict() for doc in
+            db.collection('documents').where('user', '==', user).stream()]
+
+
+def uncached_first(db, user, doc_type):
+    documents = db.collection('documents').where('type', '==', doc_type).where('user', '==', user).stream()
+    for doc in documents:
+        return doc.to_dict()
+    return None
+
+
+def replay(db, ops, index=None):
+    start = time.perf_counter()
+    for op, user, doc_type in ops:
+        if op == 'all':
+            index.all_for(user) if index else uncached_all(db, user)
+        elif op == 'first':
+            index.first_of_type(user, doc_type) if index else uncached_first(db, user, doc_type)
+        else:
+            db.collection('documents').add({'type': doc_type, 'user': user, 'url': 'x',
+                                            'created': time.time()})
+            if index:
+                index.invalidate(user)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--docs-per-user', type=int, default=30)
+    parser.add_argument('--lookups', type=int, default=2000)
+    parser.add_argument('--upload-ratio', type=float, default=0.05)
+    parser.add_argument('--latency-ms', type=float, default=2.0)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    users = [f"whatsapp:+1555{i:07d}" for i in range(args.users)]
+    ops = []
+    for _ in range(args.lookups):
+        user = rng.choice(users)
+        r = rng.random()
+        if r < args.upload_ratio:
+            ops.append(('upload', user, rng.choice(MENUS['send'])))
+        elif r < 0.5:
+            ops.append(('all', user, None))
+        else:
+            ops.append(('first', user, rng.choice(MENUS['receive'])))
+
+    for label, cached in (('uncached', False), ('cached', True)):
+        db = FakeFirestore()
+        seed(db, users, args.docs_per_user, random.Random(1))
+        db.latency = args.latency_ms / 1000
+        db.reads = 0
+        index = DocumentIndex(db) if cached else None
+        elapsed = replay(db, ops, index)
+        print(f"{label:>9}: {elapsed:6.2f}s, {db.reads} Firestore queries, "
+              f"{elapsed / len(ops) * 1000:.2f} ms/op")
+        if index:
+            print(f"           {index.stats()}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Sequential media fetches: fresh connection per request vs pooled session.
+
+The stand-in server is plain HTTP on loopback, so this only measures TCP
+setup and per-request client overhead; against Twilio's HTTPS endpoint
+the pooled session also skips a TLS handshake per fetch.
+
+    python benchmarks/bench_http_pool.py --fetches 500 --size-kb 64
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import requests  # noqa: E402
+
+from benchmarks.fakes import MediaServer  # noqa: E402
+from clients import pooled_session  # noqa: E402
+
+
+def fetch_all(get, url, fetches):
+    start = time.perf_counter()
+    for _ in range(fetches):
+        response = get(url, timeout=(5, 30))
+        assert response.status_code == 200
+        response.content
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fetches', type=int, default=500)
+    parser.add_argument('--size-kb', type=int, default=64)
+    args = parser.parse_args()
+
+    with MediaServer(args.size_kb * 1024) as server:
+        unpooled = fetch_all(requests.get, server.url, args.fetches)
+        session = pooled_session()
+        pooled = fetch_all(session.get, server.url, args.fetches)
+        session.close()
+
+    for label, elapsed in (('unpooled', unpooled), ('pooled', pooled)):
+        print(f"{label:>9}: {elapsed:6.2f}s, {elapsed / args.fetches * 1000:6.2f} ms/fetch")
+    print(f"  speedup: {unpooled / pooled:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
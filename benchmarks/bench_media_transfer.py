@@ -0,0 +1,89 @@
+"""Compare buffered vs spooled media transfer: peak RSS and wall time.
+
+"spooled" is the ingestion path: spool_media() hashes the download into a
+SpooledTemporaryFile (in memory up to --spool-mb, on disk beyond) and the
+blob is uploaded from that file. Each mode runs in a fresh interpreter so
+ru_maxrss reflects only that run.
+
+    python benchmarks/bench_media_transfer.py --size-mb 50 --transfers 5
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import requests  # noqa: E402
+
+from benchmarks.fakes import FakeBucket, MediaServer  # noqa: E402
+from media import spool_media  # noqa: E402
+
+
+def buffered_transfer(url, blob):
+    response = requests.get(url)
+    media_data = response.content if response.status_code == 200 else None
+    blob.upload_from_string(media_data, content_type='application/pdf')
+
+
+def spooled_transfer(url, blob, chunk_size, spool_bytes):
+    spool, size, digest = spool_media(url, None, chunk_size=chunk_size, spool_bytes=spool_bytes)
+    with spool:
+        blob.chunk_size = chunk_size
+        blob.upload_from_file(spool, content_type='application/pdf', size=size)
+
+
+def run_one(mode, size, transfers, chunk_size, spool_bytes):
+    bucket = FakeBucket()
+    with MediaServer(size) as server:
+        start = time.perf_counter()
+        for i in range(transfers):
+            blob = bucket.blob(f"documents/bench_{i}.pdf")
+            if mode == 'buffered':
+                buffered_transfer(server.url, blob)
+            else:
+                spooled_transfer(server.url, blob, chunk_size, spool_bytes)
+            assert blob.size == size
+        elapsed = time.perf_counter() - start
+    # ru_maxrss is KiB on Linux, bytes on macOS.
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        peak *= 1024
+    print(f"{elapsed:.4f} {peak}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=50)
+    parser.add_argument('--transfers', type=int, default=5)
+    parser.add_argument('--chunk-kb', type=int, default=1024)
+    parser.add_argument('--spool-mb', type=int, default=4)
+    parser.add_argument('--mode', choices=['buffered', 'spooled'])
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    chunk_size = args.chunk_kb * 1024
+    spool_bytes = args.spool_mb * 1024 * 1024
+    if args.mode:
+        run_one(args.mode, size, args.transfers, chunk_size, spool_bytes)
+        return
+
+    print(f"{args.transfers} transfers of {args.size_mb} MB, chunk {args.chunk_kb} KB, "
+          f"spool {args.spool_mb} MB")
+    for mode in ('buffered', 'spooled'):
+        out = subprocess.run(
+            [sys.executable, __file__, '--mode', mode,
+             '--size-mb', str(args.size_mb), '--transfers', str(args.transfers),
+             '--chunk-kb', str(args.chunk_kb), '--spool-mb', str(args.spool_mb)],
+            check=True, capture_output=True, text=True
+        ).stdout.split()
+        elapsed, peak = float(out[0]), int(out[1])
+        print(f"{mode:>9}: {elapsed:7.3f}s total, "
+              f"{elapsed / args.transfers * 1000:8.1f} ms/transfer, "
+              f"peak RSS {peak / (1024 * 1024):7.1f} MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""Per-request cost of the webhook instrumentation.
+
+Runs the /whatsapp handler twice over the same conversations: bare, and
+as webhook.answer() inside metrics.request(), i.e. with every timer
+app.py uses. The handler does the I/O a real request does: the state
+lives in the SQLite store every worker shares, and the actions look
+documents up through the DocumentIndex over a FakeFirestore sleeping
+--latency-ms per query. Each simulated user walks the menus like
+load_test.py does. Both versions are also run as full requests through
+Flask's test client, and the timers are measured on their own.
+
+    python benchmarks/bench_metrics.py --conversations 200 --latency-ms 20
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from flask import Flask, request  # noqa: E402
+from twilio.twiml.messaging_response import MessagingResponse  # noqa: E402
+
+from benchmarks.fakes import FakeFirestore  # noqa: E402
+from conversation import build_flow  # noqa: E402
+from document_index import DocumentIndex  # noqa: E402
+from metrics import Metrics  # noqa: E402
+from state_store import SQLiteStateStore  # noqa: E402
+import webhook  # noqa: E402
+from webhook import answer, reply_document, reply_documents  # noqa: E402
+
+SCRIPT = ['hi', '3', 'hi', '2', '1', 'hi', '2', '2', 'hi', '1', '2', '4']
+
+
+def build(latency):
+    db = FakeFirestore(latency=latency)
+    for i in range(50):
+        db.collection('documents').add({'user': f"whatsapp:+1555{i:07d}", 'type': 'Aadhar Card',
+                                        'url': f"https://storage.example/{i}", 'created': i})
+    documents = DocumentIndex(db)
+    flow = build_flow()
+
+    @flow.action('show_all_documents')
+    def show_all_documents(turn):
+        reply_documents(turn, documents.all_for(turn.from_number))
+
+    @flow.action('receive_document')
+    def receive_document(turn, doc_type):
+        reply_document(turn, doc_type, documents.first_of_type(turn.from_number, doc_type))
+
+    @flow.action('queue_document')
+    def queue_document(turn):
+        pass
+
+    flow.check_actions()
+    return flow
+
+
+def bare(flow, state_store, from_number, text):
+    # webhook.answer() without its timers.
+    resp = MessagingResponse()
+    msg = resp.message()
+    stored_state = state_store.get(from_number)
+    state = stored_state or flow.start
+    next_state = flow.dispatch(state, text, False, msg.body, from_number=from_number)
+    if next_state != stored_state:
+        state_store.transition(from_number, stored_state, next_state)
+    return str(resp)
+
+
+def instrumented(flow, state_store, from_number, text):
+    with webhook.metrics.request('whatsapp') as trace:
+        return answer(flow, state_store, trace, from_number, text, False, {})
+
+
+def instrumentation_only(metrics, state):
+    """The timers a request goes through, with nothing inside them."""
+    with metrics.request('whatsapp') as trace:
+        with metrics.timer('state_lookup'):
+            pass
+        trace.state = state
+        with metrics.timer('dispatch', state):
+            pass
+        with metrics.timer('state_transition', state):
+            pass
+        with metrics.timer('twiml_serialize'):
+            pass
+
+
+def flask_client(handler):
+    app = Flask(__name__)
+
+    @app.route('/whatsapp', methods=['POST'])
+    def whatsapp():
+        return handler(request.values.get('From', ''),
+                       request.values.get('Body', '').lower().strip())
+
+    return app.test_client()
+
+
+def run(handler, workload):
+    start = time.perf_counter()
+    for from_number, text in workload:
+        handler(from_number, text)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--conversations', type=int, default=200)
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    latency = args.latency_ms / 1000
+    workload = [(f"whatsapp:+1555{user:07d}", text)
+                for text in SCRIPT for user in range(args.conversations)]
+    directory = tempfile.mkdtemp(prefix='bench_metrics')
+
+    def store(label, round_no):
+        return SQLiteStateStore(os.path.join(directory, f"{label}-{round_no}.db"))
+
+    def compare(label, make_bare, make_instrumented):
+        # Alternate the two, each on a fresh store and document cache, so
+        # drift on a shared machine hits both alike.
+        bare_times, instrumented_times = [], []
+        for round_no in range(args.repeat):
+            bare_times.append(run(make_bare(build(latency), store(f'{label}-bare', round_no)),
+                                  workload))
+            instrumented_times.append(run(make_instrumented(
+                build(latency), store(f'{label}-instrumented', round_no)), workload))
+        n = len(workload)
+        bare_us = min(bare_times) / n * 1e6
+        instrumented_us = min(instrumented_times) / n * 1e6
+        overhead = instrumented_us - bare_us
+        print(f"{label}: bare {bare_us:8.1f} us, instrumented {instrumented_us:8.1f} us, "
+              f"overhead {overhead:6.1f} us ({overhead / bare_us * 100:+.2f}%)")
+        return bare_us
+
+    states = ['greeting', 'waiting_for_action', 'waiting_for_document_type']
+    for slow_seconds in (2.0, None):
+        metrics = Metrics(slow_seconds=slow_seconds)
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for i in range(20000):
+                instrumentation_only(metrics, states[i % 3])
+            timings.append(time.perf_counter() - start)
+        own_us = min(timings) / 20000 * 1e6
+        print(f"instrumentation alone (slow_seconds={slow_seconds}): {own_us:5.1f} us/request")
+
+    print(f"{len(workload)} requests, Firestore latency {args.latency_ms:g} ms")
+    compare('handler      ',
+            lambda flow, state_store: lambda u, t: bare(flow, state_store, u, t),
+            lambda flow, state_store: lambda u, t: instrumented(flow, state_store, u, t))
+
+    def via_flask(handler):
+        client = flask_client(handler)
+        return lambda u, t: client.post('/whatsapp', data={'From': u, 'Body': t})
+
+    compare('flask request',
+            lambda flow, state_store: via_flask(lambda u, t: bare(flow, state_store, u, t)),
+            lambda flow, state_store: via_flask(
+                lambda u, t: instrumented(flow, state_store, u, t)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Both webhooks backed by the offline fakes, for load tests on one machine.
+
+Firestore, Cloud Storage and Twilio are replaced by the fakes in
+fakes.py, each sleeping FAKE_LATENCY_SECONDS (default 0.02) per round
+trip; media is fetched over HTTP from a MediaServer. Start the media
+server, then either app under gunicorn:
+
+    python benchmarks/fake_stack.py --port 8081 --size 200000
+    gunicorn -w 1 -k gthread --threads 16 -b :5000 'benchmarks.fake_stack:sync_app()'
+    gunicorn -w 1 -b :5001 benchmarks.fake_stack:async_app \\
+        --worker-class aiohttp.GunicornWebWorker
+
+and point load_test.py at it with --media-url http://127.0.0.1:8081/media.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from benchmarks.fakes import FakeBucket, FakeFirestore, FakeTwilio, MediaServer  # noqa: E402
+
+LATENCY = float(os.getenv('FAKE_LATENCY_SECONDS', 0.02))
+
+
+def sync_app():
+    import app
+
+    app.db.set(FakeFirestore(latency=LATENCY))
+    app.bucket.set(FakeBucket(latency=LATENCY))
+    app.twilio_client.set(FakeTwilio(latency=LATENCY))
+    return app.app
+
+
+async def async_app():
+    from async_app import create_app
+
+    return await create_app(db=FakeFirestore(latency=LATENCY, asynchronous=True),
+                            bucket=FakeBucket(latency=LATENCY),
+                            twilio=FakeTwilio(latency=LATENCY))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve fake Twilio media until interrupted.")
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--size', type=int, default=200 * 1000)
+    args = parser.parse_args()
+
+    with MediaServer(args.size, content_type='image/jpeg', unique=True, port=args.port) as server:
+        print(f"Serving {args.size} bytes of media at {server.url}", flush=True)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
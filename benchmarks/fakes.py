@@ -0,0 +1,288 @@
+"""Offline stand-ins for Twilio, its media hosting, Cloud Storage and Firestore."""
+import asyncio
+import itertools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.chunk_size = None
+        self.content_type = None
+        self.size = 0
+
+    @property
+    def public_url(self):
+        return f"https://storage.example/{self.bucket.name}/{self.name}"
+
+    def upload_from_string(self, data, content_type=None):
+        self.content_type = content_type
+        # Keep a copy, as the real client does while building the request.
+        payload = bytes(data)
+        self.size = len(payload)
+        self.bucket.objects[self.name] = self
+
+    def upload_from_file(self, file_obj, content_type=None, size=None):
+        self.content_type = content_type
+        read_size = self.chunk_size or 1024 * 1024
+        self.size = 0
+        while True:
+            chunk = file_obj.read(read_size)
+            if not chunk:
+                break
+            self.size += len(chunk)
+            if self.bucket.latency:
+                time.sleep(self.bucket.latency)
+        self.bucket.objects[self.name] = self
+
+    def make_public(self):
+        if self.bucket.latency:
+            time.sleep(self.bucket.latency)
+
+
+class FakeBucket:
+    """A Cloud Storage bucket; `latency` seconds are slept per upload chunk
+    and per make_public() call."""
+
+    def __init__(self, name='fake-bucket', latency=0.0):
+        self.name = name
+        self.latency = latency
+        self.objects = {}
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+
+class FakeSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+class FakeQuery:
+    def __init__(self, collection, filters=(), limit=None, order=None):
+        self._collection = collection
+        self._filters = filters
+        self._limit = limit
+        self._order = order
+
+    def where(self, field, op, value):
+        if op != '==':
+            raise NotImplementedError(op)
+        return FakeQuery(self._collection, self._filters + ((field, value),),
+                         self._limit, self._order)
+
+    def order_by(self, field, direction='ASCENDING'):
+        return FakeQuery(self._collection, self._filters, self._limit, (field, direction))
+
+    def limit(self, count):
+        return FakeQuery(self._collection, self._filters, count, self._order)
+
+    def stream(self):
+        client = self._collection.client
+        if client.asynchronous:
+            return self._stream_async()
+        client.reads += 1
+        if client.latency:
+            time.sleep(client.latency)
+        return iter(self._matches())
+
+    async def _stream_async(self):
+        client = self._collection.client
+        client.reads += 1
+        if client.latency:
+            await asyncio.sleep(client.latency)
+        for doc in self._matches():
+            yield doc
+
+    def _matches(self):
+        matches = [
+            FakeSnapshot(doc_id, data)
+            for doc_id, data in list(self._collection.docs.items())
+            if all(data.get(field) == value for field, value in self._filters)
+        ]
+        if self._order is not None:
+            # Like Firestore, ordering on a field leaves out records without it.
+            field, direction = self._order
+            matches = sorted((doc for doc in matches if field in doc._data),
+                             key=lambda doc: doc._data[field],
+                             reverse=direction == 'DESCENDING')
+        return matches[:self._limit]
+
+
+class FakeDocumentRef:
+    def __init__(self, collection, doc_id):
+        self._collection = collection
+        self.id = doc_id
+
+    def set(self, data):
+        client = self._collection.client
+        client.writes += 1
+        if client.latency:
+            time.sleep(client.latency)
+        self._collection.docs[self.id] = dict(data)
+
+
+class FakeWriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, ref, data):
+        self._writes.append((ref, dict(data)))
+
+    def commit(self):
+        if self._client.asynchronous:
+            return self._commit_async()
+        # One round trip for the whole batch.
+        self._client.writes += 1
+        if self._client.latency:
+            time.sleep(self._client.latency)
+        self._apply()
+
+    async def _commit_async(self):
+        self._client.writes += 1
+        if self._client.latency:
+            await asyncio.sleep(self._client.latency)
+        self._apply()
+
+    def _apply(self):
+        for ref, data in self._writes:
+            ref._collection.docs[ref.id] = data
+        self._writes = []
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.docs = {}
+        self._ids = itertools.count()
+        super().__init__(self)
+
+    def document(self, doc_id=None):
+        if doc_id is None:
+            doc_id = f"doc{next(self._ids)}"
+        return FakeDocumentRef(self, doc_id)
+
+    def add(self, data):
+        ref = self.document()
+        ref.set(data)
+        return None, ref
+
+
+class FakeFirestore:
+    """Just enough of firestore.Client for the bot's queries.
+
+    `latency` seconds are slept on every query and write to stand in for
+    the network round trip. With `asynchronous`, queries stream and
+    batches commit like firestore's AsyncClient.
+    """
+
+    def __init__(self, latency=0.0, asynchronous=False):
+        self.latency = latency
+        self.asynchronous = asynchronous
+        self.reads = 0
+        self.writes = 0
+        self._collections = {}
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def collection(self, name):
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(self, name)
+        return self._collections[name]
+
+
+class _FakeMessages:
+    def __init__(self, latency):
+        self.latency = latency
+        self.sent = []
+
+    def create(self, from_, to, body):
+        if self.latency:
+            time.sleep(self.latency)
+        self.sent.append((to, body))
+
+    async def create_async(self, from_, to, body):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.sent.append((to, body))
+
+
+class _FakeHttpClient:
+    async def close(self):
+        pass
+
+
+class FakeTwilio:
+    """Just enough of twilio.rest.Client to send messages, sync or async.
+
+    Sent messages are kept in `messages.sent`; each send sleeps `latency`.
+    """
+
+    def __init__(self, latency=0.0):
+        self.messages = _FakeMessages(latency)
+        self.http_client = _FakeHttpClient()
+
+
+class MediaServer:
+    """Serves `size` bytes of media on every GET, like Twilio's media URLs.
+
+    Responses carry `status`; without `content_length` the body is
+    delimited by closing the connection instead. With `unique`, every
+    response starts with a request counter, so no two hash alike.
+    """
+
+    def __init__(self, size, content_type='application/pdf', status=200, content_length=True,
+                 unique=False, port=0):
+        payload = b'\0' * (64 * 1024)
+        counter = itertools.count()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                if content_length:
+                    self.send_header('Content-Length', str(size))
+                else:
+                    self.send_header('Connection', 'close')
+                    self.close_connection = True
+                self.end_headers()
+                first = payload
+                if unique:
+                    prefix = b'%016d' % next(counter)
+                    first = prefix + payload[len(prefix):]
+                remaining = size
+                while remaining > 0:
+                    n = min(remaining, len(payload))
+                    try:
+                        self.wfile.write((first if remaining == size else payload)[:n])
+                    except (BrokenPipeError, ConnectionResetError):
+                        return
+                    remaining -= n
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/media"
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
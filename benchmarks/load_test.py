@@ -0,0 +1,125 @@
+"""Load-test a running /whatsapp webhook with many concurrent conversations.
+
+Each simulated user walks the menus (greeting, show all documents, receive
+a document, abandon the send flow) as fast as replies come back. With
+--media-url it then sends a PAN Card as media, which queues a download,
+upload and Firestore write; the run waits until /metrics shows every
+queued document reported back to the user.
+
+To compare the sync and async webhooks on one machine, run each against
+the fakes in fake_stack.py (see there), e.g.
+
+    python benchmarks/load_test.py --url http://127.0.0.1:5000/whatsapp \
+        --media-url http://127.0.0.1:8081/media --conversations 100
+    python benchmarks/load_test.py --url http://127.0.0.1:5001/whatsapp \
+        --media-url http://127.0.0.1:8081/media --conversations 100
+
+Point it at a staging deployment the same way. Under gunicorn, /metrics
+adds up every worker on the node, but the other workers' numbers are up
+to METRICS_FLUSH_SECONDS old, which the ingestion time includes.
+"""
+import argparse
+import asyncio
+import re
+import time
+
+import aiohttp
+
+SCRIPT = ['hi', '3', 'hi', '2', '1', 'hi', '1', '2', '4']
+# Send docs -> PAN Card -> one media message.
+MEDIA_SCRIPT = ['hi', '1', '2', None]
+
+SENT = re.compile(r'^whatsapp_stage_seconds_count\{stage="twilio_send",state=""\} (\d+)$', re.M)
+
+
+async def conversation(session, url, run_id, user, rounds, media_url, latencies, errors, busy):
+    script = SCRIPT + MEDIA_SCRIPT if media_url else SCRIPT
+    for round_no in range(rounds):
+        for i, body in enumerate(script):
+            form = {
+                'From': f"whatsapp:+1555{user:07d}{run_id}",
+                'Body': body or '',
+                'NumMedia': '0',
+                'MessageSid': f"SMload{run_id}{user:07d}{round_no:04d}{i:02d}",
+            }
+            if body is None:
+                form.update(NumMedia='1', MediaUrl0=media_url, MediaContentType0='image/jpeg')
+            start = time.perf_counter()
+            try:
+                async with session.post(url, data=form) as response:
+                    text = await response.text()
+                    if response.status != 200:
+                        errors.append(response.status)
+                    elif "We're busy" in text:
+                        busy.append(form['MessageSid'])
+            except aiohttp.ClientError as exc:
+                errors.append(type(exc).__name__)
+            latencies.append(time.perf_counter() - start)
+
+
+async def messages_sent(session, metrics_url):
+    async with session.get(metrics_url) as response:
+        match = SENT.search(await response.text())
+    return int(match.group(1)) if match else 0
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def run(url, conversations, rounds, media_url, drain_timeout):
+    latencies, errors, busy = [], [], []
+    metrics_url = url.rsplit('/', 1)[0] + '/metrics'
+    run_id = f"{int(time.time()) % 100000:05d}"
+    connector = aiohttp.TCPConnector(limit=conversations)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        sent_before = await messages_sent(session, metrics_url) if media_url else 0
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            conversation(session, url, run_id, user, rounds, media_url, latencies, errors, busy)
+            for user in range(conversations)
+        ))
+        elapsed = time.perf_counter() - start
+        ingested = None
+        if media_url:
+            # Rejected with "We're busy", so never reported back.
+            expected = sent_before + conversations * rounds - len(busy)
+            deadline = time.perf_counter() + drain_timeout
+            while (await messages_sent(session, metrics_url) < expected
+                   and time.perf_counter() < deadline):
+                await asyncio.sleep(0.1)
+            reported = await messages_sent(session, metrics_url) - sent_before
+            ingested = (reported, time.perf_counter() - start)
+    return elapsed, ingested, sorted(latencies), errors, busy
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://127.0.0.1:5000/whatsapp')
+    parser.add_argument('--media-url', help="Also send media, served from this URL")
+    parser.add_argument('--conversations', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--drain-timeout', type=float, default=120.0,
+                        help="Seconds to wait for queued documents to be reported")
+    args = parser.parse_args()
+
+    elapsed, ingested, latencies, errors, busy = asyncio.run(
+        run(args.url, args.conversations, args.rounds, args.media_url, args.drain_timeout))
+    n = len(latencies)
+    print(f"{args.url}: {args.conversations} conversations, {n} requests in {elapsed:.2f}s")
+    print(f"  throughput: {n / elapsed:8.1f} req/s")
+    print(f"  p50: {percentile(latencies, 50) * 1000:8.1f} ms   "
+          f"p99: {percentile(latencies, 99) * 1000:8.1f} ms   "
+          f"max: {latencies[-1] * 1000 if latencies else 0:8.1f} ms")
+    if ingested is not None:
+        documents, seconds = ingested
+        print(f"  ingested: {documents} documents in {seconds:.2f}s "
+              f"({documents / seconds:.1f}/s), {len(busy)} rejected as busy")
+    print(f"  errors: {len(errors)}")
+
+
+if __name__ == '__main__':
+    main()
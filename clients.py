@@ -0,0 +1,56 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class ProcessLocal:
+    """Builds a client lazily, once per process, and proxies attribute access.
+
+    gRPC channels and connection pools must not be shared across a fork, so
+    a gunicorn worker that inherits a ProcessLocal from a preloaded master
+    gets its own fresh client on first use.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = threading.Lock()
+        self._value = None
+        self._pid = None
+
+    def get(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._value = self._factory()
+                    self._pid = os.getpid()
+        return self._value
+
+    def set(self, value):
+        """Use `value` in this process instead of building one (e.g. a fake)."""
+        with self._lock:
+            self._value = value
+            self._pid = os.getpid()
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def pooled_session(auth=None, pool_size=10, retries=3, backoff=0.5):
+    """A requests Session with a sized keep-alive pool and GET retries."""
+    session = requests.Session()
+    session.auth = auth
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
@@ -0,0 +1,95 @@
+import io
+import threading
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it images are stored as sent.
+    Image = ImageOps = None
+
+# Formats Pillow can re-encode without changing the stored content type.
+RECOMPRESSIBLE = {'image/jpeg': 'JPEG', 'image/png': 'PNG', 'image/webp': 'WEBP'}
+
+
+def content_filename(doc_type, digest, content_type):
+    """Blob name for content-addressed storage: identical bytes, identical name."""
+    extension = content_type.split('/')[-1]
+    return f"{doc_type.replace(' ', '_').lower()}_{digest}.{extension}"
+
+
+def recompress_image(fileobj, content_type, max_dimension=2000, quality=85):
+    """Downscale and re-encode an image, keeping its format.
+
+    The EXIF orientation is applied to the pixels first, since re-encoding
+    drops the tag and phone photos would otherwise be stored sideways.
+    Returns a new file object and its size, or None when Pillow is not
+    installed, the format is not supported, the image cannot be decoded
+    safely, or the result is not smaller. `fileobj` is rewound either way.
+    """
+    image_format = RECOMPRESSIBLE.get(content_type)
+    if Image is None or image_format is None:
+        return None
+    fileobj.seek(0, io.SEEK_END)
+    original_size = fileobj.tell()
+    fileobj.seek(0)
+    try:
+        with Image.open(fileobj) as image:
+            # Lets JPEG decode at a reduced scale; exif_transpose() would
+            # otherwise load the full-size image, tag or not.
+            image.draft('RGB', (max_dimension, max_dimension))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((max_dimension, max_dimension))
+            out = io.BytesIO()
+            if image_format == 'JPEG':
+                image.save(out, 'JPEG', quality=quality, optimize=True, progressive=True)
+            elif image_format == 'WEBP':
+                image.save(out, 'WEBP', quality=quality)
+            else:
+                image.save(out, 'PNG', optimize=True)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    finally:
+        fileobj.seek(0)
+    size = out.tell()
+    if size >= original_size:
+        return None
+    out.seek(0)
+    return out, size
+
+
+class ContentStats:
+    """Counters for deduplication and compression savings."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.duplicates = 0
+        self.bytes_received = 0
+        self.bytes_stored = 0
+        self.dedup_bytes_saved = 0
+        self.compression_bytes_saved = 0
+
+    def record_duplicate(self, size):
+        with self._lock:
+            self.lookups += 1
+            self.duplicates += 1
+            self.bytes_received += size
+            self.dedup_bytes_saved += size
+
+    def record_stored(self, received, stored):
+        with self._lock:
+            self.lookups += 1
+            self.bytes_received += received
+            self.bytes_stored += stored
+            self.compression_bytes_saved += received - stored
+
+    def stats(self):
+        with self._lock:
+            return {
+                'lookups': self.lookups,
+                'duplicates': self.duplicates,
+                'dedup_hit_rate': self.duplicates / self.lookups if self.lookups else 0.0,
+                'bytes_received': self.bytes_received,
+                'bytes_stored': self.bytes_stored,
+                'dedup_bytes_saved': self.dedup_bytes_saved,
+                'compression_bytes_saved': self.compression_bytes_saved,
+            }
@@ -0,0 +1,86 @@
+from flow import END, FlowEngine
+
+MENUS = {
+    'main': ['Send docs', 'Receive docs', 'Show all documents', 'End chat'],
+    'send': [
+        'Aadhar Card', 'PAN Card', 'Form 16', 'Bank Statement',
+        'Capital Gain Statement', 'House Property Documents', 'Other Documents'
+    ],
+    'receive': ['Aadhar Card', 'PAN Card', 'ITR Related Docs'],
+}
+
+END_CHAT = {'reply': "Chat ended. You can start over by sending any message.", 'next': END}
+
+SPEC = {
+    'greeting': {
+        'any': {'reply': "Hello! How can I assist you?\n\n{menu[main]}",
+                'next': 'waiting_for_action'},
+    },
+    'waiting_for_action': {
+        'options': {
+            '1': {'reply': "Which document do you want to send?\n\n{menu[send]}",
+                  'next': 'waiting_for_document_type'},
+            '2': {'reply': "Which document do you want to receive?\n\n{menu[receive]}",
+                  'next': 'waiting_for_receive_document_type'},
+            '3': {'reply': "Showing all documents...",
+                  'action': 'show_all_documents', 'next': END},
+            '4': END_CHAT,
+        },
+        'otherwise': {'reply': "Please choose an option:\n{menu[main]}"},
+    },
+    # No '4' to end the chat here: it picks Bank Statement.
+    'waiting_for_document_type': {
+        'choices': ('send', {
+            'reply': "Please send the {choice} now.",
+            'next': {'state': 'waiting_for_document', 'doc_type': '{choice}'},
+        }),
+        'otherwise': {'reply': "Invalid option. Please choose again:\n{menu[send]}"},
+    },
+    'waiting_for_receive_document_type': {
+        'options': {'4': END_CHAT},
+        'choices': ('receive', {
+            'action': 'receive_document', 'params': {'doc_type': '{choice}'}, 'next': END,
+        }),
+        'otherwise': {'reply': "Invalid option. Please choose again:\n{menu[receive]}"},
+    },
+    'waiting_for_document': {
+        'media': {'action': 'queue_document', 'next': END},
+        'options': {'4': END_CHAT},
+        'otherwise': {'reply': "Please send a document as media. To end the chat, reply with '4'."},
+    },
+}
+
+
+def ingest_report(job, max_bytes):
+    """One outbound message summarising every attachment of an ingest job."""
+    doc_type = job['doc_type']
+    results = job.get('results', {})
+    statuses = [results.get(i, 'failed') for i in range(len(job['media']))]
+    limit = f"The limit is {max_bytes // (1024 * 1024)} MB."
+    if len(statuses) == 1:
+        if statuses[0] == 'saved':
+            return f"{doc_type} received and saved."
+        if statuses[0] == 'duplicate':
+            return f"This {doc_type} was already saved earlier, so it wasn't stored again."
+        if statuses[0] == 'too_large':
+            return f"Your {doc_type} is too large. {limit}"
+        return f"Failed to save your {doc_type}. Please send it again."
+
+    saved = statuses.count('saved') + statuses.count('duplicate')
+    lines = [f"{saved} of {len(statuses)} {doc_type} files saved."]
+    for i, status in enumerate(statuses, 1):
+        if status == 'duplicate':
+            lines.append(f"File {i}: already saved earlier.")
+        elif status == 'too_large':
+            lines.append(f"File {i}: too large. {limit}")
+        elif status != 'saved':
+            lines.append(f"File {i}: failed. Please send it again.")
+    return '\n'.join(lines)
+
+
+def build_flow():
+    return FlowEngine(SPEC, MENUS, start='greeting',
+                      error_reply="An error occurred. Please start over.")
+
+
+flow = build_flow()
@@ -0,0 +1,210 @@
+import asyncio
+import threading
+import time
+import uuid
+
+from cachetools import TTLCache
+
+from state_store import MemoryStateStore
+
+
+class _UserDocuments:
+    """What is cached for one user: every record, and/or the newest per type."""
+
+    __slots__ = ('version', 'all', 'latest')
+
+    def __init__(self, version):
+        self.version = version
+        self.all = None
+        self.latest = {}
+
+
+class DocumentIndex:
+    """Read-through cache of each user's Firestore document records.
+
+    Entries expire after `ttl` seconds and the least recently used users
+    are evicted beyond `max_users`. Ingestion calls `invalidate()` after
+    writing a user's records; it bumps a per-user version in `versions`, a
+    StateStore, and cached entries are only used while their version is
+    current. Pass the app's shared state store so an invalidation reaches
+    every worker using it; the default in-memory one only covers this
+    process. `find_by_hash()` is never cached, since a stale miss would
+    store the same document twice.
+    """
+
+    def __init__(self, db, collection='documents', ttl=300, max_users=5000, versions=None):
+        self.db = db
+        self.collection = collection
+        self.ttl = ttl
+        self.versions = versions if versions is not None else MemoryStateStore(
+            ttl=ttl, max_entries=max_users)
+        self._cache = TTLCache(maxsize=max_users, ttl=ttl)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.queries = 0
+        self.query_seconds = 0.0
+
+    def all_for(self, user):
+        entry = self._entry(user, self.versions.get(self._version_key(user)))
+        if self._cached_all(entry):
+            return entry.all
+        start = time.perf_counter()
+        snapshots = list(self._all_query(user).stream())
+        self._record_query(start)
+        entry.all = tuple(doc.to_dict() for doc in snapshots)
+        return entry.all
+
+    def first_of_type(self, user, doc_type):
+        """The newest record of `doc_type`, or None."""
+        entry = self._entry(user, self.versions.get(self._version_key(user)))
+        found, document = self._cached_latest(entry, doc_type)
+        if found:
+            return document
+        start = time.perf_counter()
+        snapshots = list(self._first_query(user, doc_type).stream())
+        if not snapshots:
+            snapshots = list(self._first_query(user, doc_type, ordered=False).stream())
+        self._record_query(start)
+        document = snapshots[0].to_dict() if snapshots else None
+        entry.latest[doc_type] = document
+        return document
+
+    def find_by_hash(self, user, doc_type, content_hash):
+        start = time.perf_counter()
+        snapshots = list(self._hash_query(user, doc_type, content_hash).stream())
+        self._record_query(start)
+        return snapshots[0].to_dict() if snapshots else None
+
+    def invalidate(self, user):
+        self.versions.set(self._version_key(user), uuid.uuid4().hex, ttl=self.ttl)
+        self._forget(user)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'queries': self.queries,
+                'avg_query_ms': self.query_seconds / self.queries * 1000 if self.queries else 0.0,
+                'cached_users': len(self._cache),
+            }
+
+    def _all_query(self, user):
+        return self.db.collection(self.collection).where('user', '==', user)
+
+    def _first_query(self, user, doc_type, ordered=True):
+        query = (self.db.collection(self.collection)
+                 .where('type', '==', doc_type)
+                 .where('user', '==', user))
+        if ordered:
+            query = query.order_by('created', direction='DESCENDING')
+        # Records written before 'created' existed are left out of ordered
+        # queries, so an empty ordered result is retried unordered.
+        return query.limit(1)
+
+    def _hash_query(self, user, doc_type, content_hash):
+        return (self.db.collection(self.collection)
+                .where('content_hash', '==', content_hash)
+                .where('type', '==', doc_type)
+                .where('user', '==', user)
+                .limit(1))
+
+    def _version_key(self, user):
+        return f"{self.collection}:{user}"
+
+    def _entry(self, user, version):
+        # Versions are read before querying, so a write that lands during
+        # the query leaves this entry stale for the next lookup.
+        with self._lock:
+            entry = self._cache.get(user)
+            if entry is None or entry.version != version:
+                entry = self._cache[user] = _UserDocuments(version)
+            return entry
+
+    def _forget(self, user):
+        with self._lock:
+            self._cache.pop(user, None)
+
+    def _cached_all(self, entry):
+        with self._lock:
+            hit = entry.all is not None
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return hit
+
+    def _cached_latest(self, entry, doc_type):
+        with self._lock:
+            if entry.all is not None:
+                self.hits += 1
+                return True, self._newest(entry.all, doc_type)
+            if doc_type in entry.latest:
+                self.hits += 1
+                return True, entry.latest[doc_type]
+            self.misses += 1
+            return False, None
+
+    def _newest(self, documents, doc_type):
+        matches = [document for document in documents if document['type'] == doc_type]
+        if not matches:
+            return None
+        return max(matches, key=lambda document: document.get('created', 0))
+
+    def _record_query(self, start):
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.queries += 1
+            self.query_seconds += elapsed
+
+
+class AsyncDocumentIndex(DocumentIndex):
+    """DocumentIndex over firestore's AsyncClient; lookups are coroutines."""
+
+    async def all_for(self, user):
+        entry = self._entry(user, await self._version(user))
+        if self._cached_all(entry):
+            return entry.all
+        start = time.perf_counter()
+        snapshots = [doc async for doc in self._all_query(user).stream()]
+        self._record_query(start)
+        entry.all = tuple(doc.to_dict() for doc in snapshots)
+        return entry.all
+
+    async def first_of_type(self, user, doc_type):
+        entry = self._entry(user, await self._version(user))
+        found, document = self._cached_latest(entry, doc_type)
+        if found:
+            return document
+        start = time.perf_counter()
+        snapshots = [doc async for doc in self._first_query(user, doc_type).stream()]
+        if not snapshots:
+            snapshots = [doc async for doc in
+                         self._first_query(user, doc_type, ordered=False).stream()]
+        self._record_query(start)
+        document = snapshots[0].to_dict() if snapshots else None
+        entry.latest[doc_type] = document
+        return document
+
+    async def find_by_hash(self, user, doc_type, content_hash):
+        start = time.perf_counter()
+        snapshots = [doc async for doc in
+                     self._hash_query(user, doc_type, content_hash).stream()]
+        self._record_query(start)
+        return snapshots[0].to_dict() if snapshots else None
+
+    async def invalidate(self, user):
+        await self._call_versions(self.versions.set, self._version_key(user),
+                                  uuid.uuid4().hex, self.ttl)
+        self._forget(user)
+
+    async def _version(self, user):
+        return await self._call_versions(self.versions.get, self._version_key(user))
+
+    async def _call_versions(self, fn, *args):
+        if self.versions.blocking:
+            return await asyncio.to_thread(fn, *args)
+        return fn(*args)
@@ -0,0 +1,215 @@
+import sys
+
+
+class _Marker:
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+
+# Transition targets besides a state name or state dict.
+STAY = _Marker('STAY')
+END = _Marker('END')
+
+
+class Turn:
+    """What an action sees of the incoming message."""
+
+    __slots__ = ('from_number', 'values', 'state', 'reply')
+
+    def __init__(self, from_number, values, state, reply):
+        self.from_number = from_number
+        self.values = values
+        self.state = state
+        self.reply = reply
+
+
+class Transition:
+    __slots__ = ('reply', 'action', 'params', 'next')
+
+    def __init__(self, reply=None, action=None, params=None, next=STAY):
+        self.reply = reply
+        self.action = action
+        self.params = params or {}
+        self.next = next
+
+
+class CompiledState:
+    __slots__ = ('name', 'any', 'media', 'options', 'otherwise')
+
+    def __init__(self, name, any=None, media=None, options=None, otherwise=None):
+        self.name = name
+        self.any = any
+        self.media = media
+        self.options = options or {}
+        self.otherwise = otherwise
+
+
+def render_menu(items):
+    return '\n'.join(f"{i}. {item}" for i, item in enumerate(items, 1))
+
+
+class FlowEngine:
+    """Conversation state machine compiled from a declarative spec.
+
+    `spec` maps state names to dicts with any of these keys, each holding a
+    transition dict ({'reply', 'action', 'params', 'next'}):
+
+    - 'any': taken for every message
+    - 'media': taken when the message carries media
+    - 'options': {text: transition} for exact replies
+    - 'choices': (menu name, transition) expanded into one option per menu
+      item, with '{choice}' in the transition replaced by the item; it may
+      not reuse a key from 'options'
+    - 'otherwise': taken when nothing else matched
+
+    Reply templates may reference '{menu[name]}' for a rendered menu. All
+    reply bodies are formatted once at compile time, so dispatching a
+    message is a couple of dict lookups.
+    """
+
+    def __init__(self, spec, menus, start, error_reply):
+        self.start = start
+        self.error_reply = sys.intern(error_reply)
+        self.menus = {name: render_menu(items) for name, items in menus.items()}
+        self.menu_items = {name: tuple(items) for name, items in menus.items()}
+        self._actions = {}
+        self._states = {name: self._compile_state(name, state_spec)
+                        for name, state_spec in spec.items()}
+        for state in self._states.values():
+            for transition in self._transitions(state):
+                self._check_target(state.name, transition.next)
+
+    def action(self, name):
+        def register(fn):
+            self._actions[name] = fn
+            return fn
+        return register
+
+    def check_actions(self):
+        """Raise unless every action the spec names has been registered.
+
+        Call it once the app has registered its actions, so a missing one
+        fails at startup rather than on the first message that needs it.
+        """
+        missing = sorted({transition.action
+                          for state in self._states.values()
+                          for transition in self._transitions(state)
+                          if transition.action is not None} - self._actions.keys())
+        if missing:
+            raise ValueError(f"Flow actions are not registered: {', '.join(missing)}")
+
+    def dispatch(self, state, text, has_media, reply, from_number=None, values=None):
+        """Run one message through the machine and return the next state.
+
+        Replies are passed to `reply`. Returns the new state value, or None
+        when the conversation ends.
+        """
+        transition = self._match(state, text, has_media, reply)
+        if transition is None:
+            return state
+        target = transition.next
+        if transition.action is not None:
+            turn = Turn(from_number, values, state, reply)
+            result = self._actions[transition.action](turn, **transition.params)
+            if result is not None:
+                target = result
+        return self._resolve(state, target)
+
+    async def dispatch_async(self, state, text, has_media, reply, from_number=None, values=None):
+        """Like `dispatch()`, for engines whose actions are coroutines."""
+        transition = self._match(state, text, has_media, reply)
+        if transition is None:
+            return state
+        target = transition.next
+        if transition.action is not None:
+            turn = Turn(from_number, values, state, reply)
+            result = await self._actions[transition.action](turn, **transition.params)
+            if result is not None:
+                target = result
+        return self._resolve(state, target)
+
+    def acts(self, state, text, has_media):
+        """Whether dispatching this message in `state` runs an action."""
+        transition = self._select(state, text, has_media)
+        return transition is not None and transition.action is not None
+
+    def _match(self, state, text, has_media, reply):
+        # The hot path, so _select() is inlined here.
+        name = state if state.__class__ is str else state.get('state')
+        compiled = self._states.get(name)
+        if compiled is None:
+            reply(self.error_reply)
+            return None
+        transition = (compiled.any
+                      or (has_media and compiled.media)
+                      or compiled.options.get(text, compiled.otherwise))
+        if transition is not None and transition.reply is not None:
+            reply(transition.reply)
+        return transition
+
+    def _select(self, state, text, has_media):
+        name = state if state.__class__ is str else state.get('state')
+        compiled = self._states.get(name)
+        if compiled is None:
+            return None
+        return (compiled.any
+                or (has_media and compiled.media)
+                or compiled.options.get(text, compiled.otherwise))
+
+    def _resolve(self, state, target):
+        if target is STAY:
+            return state
+        if target is END:
+            return None
+        return target
+
+    def _compile_state(self, name, state_spec):
+        options = {key: self._compile_transition(t)
+                   for key, t in state_spec.get('options', {}).items()}
+        if 'choices' in state_spec:
+            menu, template = state_spec['choices']
+            for key, item in enumerate(self.menu_items[menu], 1):
+                if str(key) in options:
+                    raise ValueError(f"State {name!r}: choice {key} ({item}) "
+                                     f"collides with an option")
+                options[str(key)] = self._compile_transition(template, choice=item)
+        return CompiledState(
+            name,
+            any=self._compile_transition(state_spec.get('any')),
+            media=self._compile_transition(state_spec.get('media')),
+            options=options,
+            otherwise=self._compile_transition(state_spec.get('otherwise')),
+        )
+
+    def _compile_transition(self, spec, choice=None):
+        if spec is None:
+            return None
+        fields = {'menu': self.menus, 'choice': choice}
+        return Transition(
+            reply=self._format(spec.get('reply'), fields),
+            action=spec.get('action'),
+            params=self._format(spec.get('params'), fields),
+            next=self._format(spec.get('next', STAY), fields),
+        )
+
+    def _format(self, value, fields):
+        if isinstance(value, str):
+            return sys.intern(value.format_map(fields))
+        if isinstance(value, dict):
+            return {k: self._format(v, fields) for k, v in value.items()}
+        return value
+
+    def _transitions(self, state):
+        for transition in (state.any, state.media, state.otherwise, *state.options.values()):
+            if transition is not None:
+                yield transition
+
+    def _check_target(self, source, target):
+        if target is STAY or target is END:
+            return
+        name = target.get('state') if isinstance(target, dict) else target
+        if name not in self._states:
+            raise ValueError(f"State {source!r} transitions to unknown state {name!r}")
@@ -0,0 +1,37 @@
+import os
+import shutil
+import tempfile
+
+_created_metrics_dir = None
+
+
+def on_starting(server):
+    # /metrics adds up every worker's numbers through snapshots in
+    # METRICS_DIR (see metrics.py). Give each server an empty directory of
+    # its own, so two servers on a node, or an earlier run, aren't counted
+    # in. With --preload the app reads METRICS_DIR before this hook runs,
+    # so set it explicitly.
+    global _created_metrics_dir
+    from metrics import clear_metrics_dir
+    if os.environ.get('METRICS_DIR'):
+        clear_metrics_dir(os.environ['METRICS_DIR'])
+    else:
+        _created_metrics_dir = os.environ['METRICS_DIR'] = tempfile.mkdtemp(
+            prefix='whatsapp_metrics-')
+
+
+def on_exit(server):
+    if _created_metrics_dir:
+        shutil.rmtree(_created_metrics_dir, ignore_errors=True)
+
+
+def post_worker_init(worker):
+    # Build the Firestore, Storage and Twilio clients in each forked worker
+    # so the first real message doesn't pay for channel setup. The aiohttp
+    # workers (GunicornWebWorker and its uvloop subclass) serve async_app,
+    # which builds its clients on startup instead.
+    from aiohttp.worker import GunicornWebWorker
+    if isinstance(worker, GunicornWebWorker):
+        return
+    from app import warmup
+    warmup()
@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class IdempotencyStore:
+    """Remembers which MessageSids have already been accepted for ingestion.
+
+    Backed by SQLite so that a file path can be shared by every gunicorn
+    worker on a node; a ':memory:' database only covers one process, which
+    is enough for tests. A sid still 'pending' `stale_after` seconds after
+    it was last touched is taken to belong to a worker that died with the
+    job in its in-memory queue, and can be claimed again. Rows older than
+    `retention` seconds are pruned as new sids are claimed.
+    """
+
+    def __init__(self, path=':memory:', stale_after=None, retention=None):
+        self._path = path
+        self.stale_after = stale_after
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+
+    def _conn(self):
+        # Reconnect after a fork; SQLite connections must not cross processes.
+        if self._pid != os.getpid():
+            self._connection = sqlite3.connect(self._path, timeout=10, check_same_thread=False)
+            if self._path != ':memory:':
+                self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS ingested '
+                '(sid TEXT PRIMARY KEY, status TEXT NOT NULL, updated REAL NOT NULL)'
+            )
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS ingested_updated ON ingested (updated)'
+            )
+            self._connection.commit()
+            self._pid = os.getpid()
+        return self._connection
+
+    def claim(self, sid):
+        now = time.time()
+        with self._lock:
+            conn = self._conn()
+            if self.retention is not None:
+                conn.execute('DELETE FROM ingested WHERE updated < ?', (now - self.retention,))
+            cur = conn.execute(
+                'INSERT OR IGNORE INTO ingested (sid, status, updated) VALUES (?, ?, ?)',
+                (sid, 'pending', now)
+            )
+            claimed = cur.rowcount == 1
+            if not claimed and self.stale_after is not None:
+                # Refreshing `updated` in the same statement means only one
+                # of several workers racing for a stale sid gets it.
+                cur = conn.execute(
+                    "UPDATE ingested SET updated = ? "
+                    "WHERE sid = ? AND status = 'pending' AND updated <= ?",
+                    (now, sid, now - self.stale_after)
+                )
+                claimed = cur.rowcount == 1
+                if claimed:
+                    logger.warning("Claiming %s again: it has been pending for over %ds",
+                                   sid, self.stale_after)
+            conn.commit()
+            return claimed
+
+    def mark(self, sid, status):
+        with self._lock:
+            self._conn().execute(
+                'UPDATE ingested SET status = ?, updated = ? WHERE sid = ?',
+                (status, time.time(), sid)
+            )
+            self._conn().commit()
+
+    def release(self, sid):
+        with self._lock:
+            self._conn().execute('DELETE FROM ingested WHERE sid = ?', (sid,))
+            self._conn().commit()
+
+    def status(self, sid):
+        with self._lock:
+            row = self._conn().execute(
+                'SELECT status FROM ingested WHERE sid = ?', (sid,)
+            ).fetchone()
+        return row[0] if row else None
+
+
+class IngestQueue:
+    """Bounded work queue that runs `handler(job)` on a pool of threads.
+
+    Jobs are dicts carrying at least a 'message_sid'. A job whose sid was
+    already claimed is ignored, so Twilio webhook retries never store the
+    same media twice. Failed jobs are retried with exponential backoff;
+    `on_success(job, result)` / `on_failure(job, exc)` are called once the
+    job settles. Exceptions listed in `fatal` are not retried. With
+    `workers=0` jobs run inline inside `submit()`. The claim is touched
+    before every attempt, so only a job that stopped making progress can
+    go stale in `seen`.
+    """
+
+    def __init__(self, handler, workers=4, max_depth=100, max_attempts=3,
+                 backoff=1.0, on_success=None, on_failure=None, seen=None,
+                 fatal=()):
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.fatal = tuple(fatal)
+        self.seen = seen if seen is not None else IdempotencyStore()
+        self._queue = queue.Queue(maxsize=max_depth)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+
+    def submit(self, job):
+        sid = job['message_sid']
+        if not self.seen.claim(sid):
+            return False
+        if self.workers == 0:
+            self._process(job)
+            return True
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            self.seen.release(sid)
+            raise QueueFull(f"Ingestion queue is full ({self._queue.maxsize} jobs)")
+        return True
+
+    def status(self, sid):
+        """How an already claimed sid got on: 'pending', 'done' or 'failed'."""
+        return self.seen.status(sid)
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def join(self):
+        self._queue.join()
+
+    def _ensure_started(self):
+        # Threads do not survive a fork, so start them lazily in whichever
+        # process first submits work (i.e. after gunicorn has forked).
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._threads = []
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f"ingest-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._process(job)
+            finally:
+                self._queue.task_done()
+
+    def _process(self, job):
+        sid = job['message_sid']
+        for attempt in range(1, self.max_attempts + 1):
+            self.seen.mark(sid, 'pending')
+            try:
+                result = self.handler(job)
+            except Exception as exc:
+                logger.warning("Ingestion of %s failed (attempt %d/%d): %s",
+                               sid, attempt, self.max_attempts, exc)
+                if attempt == self.max_attempts or isinstance(exc, self.fatal):
+                    self.seen.mark(sid, 'failed')
+                    self._callback(self.on_failure, job, exc)
+                    return
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            else:
+                self.seen.mark(sid, 'done')
+                self._callback(self.on_success, job, result)
+                return
+
+    def _callback(self, fn, job, arg):
+        if fn is None:
+            return
+        try:
+            fn(job, arg)
+        except Exception:
+            logger.exception("Ingestion callback failed for %s", job['message_sid'])
+
+
+class AsyncIngestQueue:
+    """asyncio counterpart of IngestQueue.
+
+    `handler` and the callbacks are coroutine functions; workers are tasks
+    on the running loop, started with `start()` and cancelled by `stop()`.
+    `submit()` and `status()` are coroutines too, because the idempotency
+    store is a SQLite file they must not block the loop on. Jobs still
+    queued or running when `stop()` is called have their claims released,
+    so a Twilio retry that reaches another worker ingests them.
+    """
+
+    def __init__(self, handler, workers=4, max_depth=100, max_attempts=3,
+                 backoff=1.0, on_success=None, on_failure=None, seen=None,
+                 fatal=()):
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.fatal = tuple(fatal)
+        self.seen = seen if seen is not None else IdempotencyStore()
+        self._queue = asyncio.Queue(maxsize=max_depth)
+        self._tasks = []
+        self._running = set()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._run(), name=f"ingest-{i}")
+                       for i in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        unfinished = set(self._running)
+        while not self._queue.empty():
+            unfinished.add(self._queue.get_nowait()['message_sid'])
+            self._queue.task_done()
+        for sid in unfinished:
+            await asyncio.to_thread(self.seen.release, sid)
+        self._running.clear()
+
+    async def submit(self, job):
+        sid = job['message_sid']
+        if not await asyncio.to_thread(self.seen.claim, sid):
+            return False
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            await asyncio.to_thread(self.seen.release, sid)
+            raise QueueFull(f"Ingestion queue is full ({self._queue.maxsize} jobs)")
+        return True
+
+    async def status(self, sid):
+        return await asyncio.to_thread(self.seen.status, sid)
+
+    def depth(self):
+        return self._queue.qsize()
+
+    async def join(self):
+        await self._queue.join()
+
+    async def _run(self):
+        while True:
+            job = await self._queue.get()
+            # Left in `_running` if cancelled, for stop() to release.
+            self._running.add(job['message_sid'])
+            try:
+                await self._process(job)
+                self._running.discard(job['message_sid'])
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, job):
+        sid = job['message_sid']
+        for attempt in range(1, self.max_attempts + 1):
+            await asyncio.to_thread(self.seen.mark, sid, 'pending')
+            try:
+                result = await self.handler(job)
+            except Exception as exc:
+                logger.warning("Ingestion of %s failed (attempt %d/%d): %s",
+                               sid, attempt, self.max_attempts, exc)
+                if attempt == self.max_attempts or isinstance(exc, self.fatal):
+                    await asyncio.to_thread(self.seen.mark, sid, 'failed')
+                    await self._callback(self.on_failure, job, exc)
+                    return
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            else:
+                await asyncio.to_thread(self.seen.mark, sid, 'done')
+                await self._callback(self.on_success, job, result)
+                return
+
+    async def _callback(self, fn, job, arg):
+        if fn is None:
+            return
+        try:
+            await fn(job, arg)
+        except Exception:
+            logger.exception("Ingestion callback failed for %s", job['message_sid'])
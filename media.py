@@ -0,0 +1,127 @@
+import asyncio
+import hashlib
+import io
+import shutil
+import tempfile
+
+import requests
+
+# Resumable uploads to Cloud Storage must be sent in multiples of 256 KiB.
+CHUNK_MULTIPLE = 256 * 1024
+
+
+class MediaError(Exception):
+    pass
+
+
+class MediaDownloadError(MediaError):
+    pass
+
+
+class MediaTooLarge(MediaError):
+    pass
+
+
+def media_items(values):
+    """The (url, content type) of every attachment in a Twilio webhook."""
+    return [
+        {'url': values[f'MediaUrl{i}'], 'content_type': values[f'MediaContentType{i}']}
+        for i in range(int(values.get('NumMedia', 0)))
+    ]
+
+
+def document_id(message_sid, index):
+    # The first attachment keeps the plain MessageSid so single-media
+    # records keep the IDs they had before multi-media support.
+    return message_sid if index == 0 else f"{message_sid}_{index}"
+
+
+class ResponseStream(io.RawIOBase):
+    """Read-only file object over a streamed `requests` response.
+
+    Only one network chunk is held at a time, and reading aborts with
+    MediaTooLarge as soon as more than `max_bytes` have been received.
+    Every chunk is fed to `hasher` when one is given.
+    """
+
+    def __init__(self, response, chunk_size, max_bytes=None, hasher=None):
+        self._chunks = response.iter_content(chunk_size=chunk_size)
+        self._buffer = b''
+        self._max_bytes = max_bytes
+        self._hasher = hasher
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+            if self._hasher is not None:
+                self._hasher.update(self._buffer)
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        self.bytes_read += n
+        if self._max_bytes is not None and self.bytes_read > self._max_bytes:
+            raise MediaTooLarge(f"Media exceeds {self._max_bytes} bytes")
+        return n
+
+
+def spool_media(media_url, auth, chunk_size=CHUNK_MULTIPLE * 4, max_bytes=None,
+                spool_bytes=4 * 1024 * 1024, session=None, timeout=(5, 30)):
+    """Download media into a temporary file, hashing it on the way.
+
+    Media up to `spool_bytes` stays in memory, anything larger spills to
+    disk. Returns (file object rewound to the start, size, sha256 hex
+    digest); the caller closes the file.
+    """
+    http = session if session is not None else requests
+    hasher = hashlib.sha256()
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+    try:
+        with http.get(media_url, auth=auth, stream=True, timeout=timeout) as response:
+            if response.status_code != 200:
+                raise MediaDownloadError(
+                    f"Media download returned HTTP {response.status_code}")
+            length = response.headers.get('Content-Length')
+            if max_bytes is not None and length is not None and int(length) > max_bytes:
+                raise MediaTooLarge(f"Media is {length} bytes, limit is {max_bytes}")
+            stream = ResponseStream(response, chunk_size, max_bytes, hasher)
+            shutil.copyfileobj(stream, spool, chunk_size)
+    except BaseException:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, stream.bytes_read, hasher.hexdigest()
+
+
+async def fetch_media_async(session, media_url, auth, fileobj,
+                            chunk_size=CHUNK_MULTIPLE * 4, max_bytes=None, hasher=None,
+                            executor=None):
+    """Stream media from `media_url` into `fileobj` using an aiohttp session.
+
+    Every chunk is also fed to `hasher` when one is given. Writes run on
+    `executor` (the loop's default one when None), since a spool that has
+    spilled to disk blocks on them.
+    Returns the number of bytes written; `fileobj` is left at the end.
+    """
+    loop = asyncio.get_running_loop()
+    async with session.get(media_url, auth=auth) as response:
+        if response.status != 200:
+            raise MediaDownloadError(f"Media download returned HTTP {response.status}")
+        if max_bytes is not None and (response.content_length or 0) > max_bytes:
+            raise MediaTooLarge(
+                f"Media is {response.content_length} bytes, limit is {max_bytes}")
+        written = 0
+        async for chunk in response.content.iter_chunked(chunk_size):
+            written += len(chunk)
+            if max_bytes is not None and written > max_bytes:
+                raise MediaTooLarge(f"Media exceeds {max_bytes} bytes")
+            if hasher is not None:
+                hasher.update(chunk)
+            await loop.run_in_executor(executor, fileobj.write, chunk)
+        return written
@@ -0,0 +1,495 @@
+"""Per-stage latency histograms, a Prometheus text renderer and a sampling profiler.
+
+Timing a stage costs two perf_counter() calls and a deque append; the
+histogram buckets are only updated in batches, so it is meant to stay on
+in production. While slow-request logging is on, stages timed inside
+`Metrics.request()` are also collected into that request's trace, which
+is logged when the request is slower than `slow_seconds`.
+
+Each gunicorn worker keeps its own histograms. Given a `directory`, every
+process writes a snapshot of them there every `flush_seconds`, and
+`render()` adds up the snapshots of every process, so /metrics shows the
+whole node whichever worker serves it; its own numbers are current, the
+other workers' up to `flush_seconds` old. Snapshots of workers that exited
+are kept, so counts never go backwards when gunicorn replaces a worker;
+gunicorn.conf.py starts every server on an empty directory. Gauges are
+per process and labelled with its pid; exited workers have none.
+"""
+import atexit
+import bisect
+import collections
+import contextlib
+import contextvars
+import cProfile
+import functools
+import glob
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 15.0)
+
+# Observations a histogram holds before folding them into its buckets.
+FOLD_AT = 256
+
+_trace = contextvars.ContextVar('metrics_trace', default=None)
+_now = time.perf_counter
+
+
+class Histogram:
+    """Bucketed observations.
+
+    `observe()` only appends to a deque, which is thread-safe without a
+    lock; whoever pushes it past FOLD_AT, or takes a snapshot, sorts the
+    backlog into the buckets under the lock.
+    """
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count', '_pending', '_lock')
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._pending = collections.deque()
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        pending = self._pending
+        pending.append(value)
+        if len(pending) >= FOLD_AT:
+            self._fold()
+
+    def snapshot(self):
+        self._fold()
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+    def _fold(self):
+        with self._lock:
+            pending = self._pending
+            bounds, counts = self.bounds, self.counts
+            # Only ever popped under the lock, so these many are there.
+            for _ in range(len(pending)):
+                value = pending.popleft()
+                counts[bisect.bisect_left(bounds, value)] += 1
+                self.sum += value
+                self.count += 1
+
+
+class Timer:
+    __slots__ = ('_histogram', '_start')
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = _now()
+        return self
+
+    def __exit__(self, *exc):
+        # Histogram.observe(), inlined: this runs for every timed stage.
+        pending = self._histogram._pending
+        pending.append(_now() - self._start)
+        if len(pending) >= FOLD_AT:
+            self._histogram._fold()
+        return False
+
+
+class _TracedTimer:
+    """Timer that also adds the stage to the current request's trace."""
+
+    __slots__ = ('_histogram', '_stage', '_start')
+
+    def __init__(self, histogram, stage):
+        self._histogram = histogram
+        self._stage = stage
+
+    def __enter__(self):
+        self._start = _now()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = _now() - self._start
+        pending = self._histogram._pending
+        pending.append(elapsed)
+        if len(pending) >= FOLD_AT:
+            self._histogram._fold()
+        trace = _trace.get()
+        if trace is not None:
+            trace.stages.append((self._stage, elapsed))
+        return False
+
+
+class RequestTrace:
+    __slots__ = ('endpoint', 'state', 'stages', 'start', '_token', '_metrics')
+
+    def __init__(self, metrics, endpoint):
+        self._metrics = metrics
+        self.endpoint = endpoint
+        self.state = ''
+        self.stages = []
+
+    def __enter__(self):
+        self._token = _trace.set(self) if self._metrics.slow_seconds is not None else None
+        self.start = _now()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = _now() - self.start
+        if self._token is not None:
+            _trace.reset(self._token)
+        self._metrics._finish_request(self, elapsed)
+        return False
+
+
+class Metrics:
+    """Registry of stage histograms, keyed by (stage, conversation state).
+
+    `slow_seconds=None` turns slow-request logging, and with it the
+    per-request stage traces, off. With a `directory`, `render()` covers
+    every process writing snapshots to it (see the module docstring).
+    """
+
+    def __init__(self, slow_seconds=2.0, buckets=DEFAULT_BUCKETS, directory=None,
+                 flush_seconds=5.0):
+        self.slow_seconds = slow_seconds
+        self.buckets = buckets
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self._stages = {}
+        self._requests = {}
+        self._slow = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._pid = None
+        self._snapshot_path = None
+
+    def timer(self, stage, state=''):
+        """Context manager timing one stage, e.g. `with metrics.timer('gcs_upload'):`."""
+        key = (stage, state)
+        histogram = self._stages.get(key)
+        if histogram is None:
+            histogram = self._histogram(self._stages, key)
+        if self.slow_seconds is None:
+            return Timer(histogram)
+        return _TracedTimer(histogram, stage)
+
+    def timed(self, stage):
+        """Decorator form of `timer()`."""
+        def decorate(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def request(self, endpoint):
+        """Context manager around a whole webhook request.
+
+        Set `trace.state` inside the block to label the request with the
+        conversation state it was handled in.
+        """
+        return RequestTrace(self, endpoint)
+
+    def add_collector(self, prefix, fn):
+        """Export the numeric values of the dict returned by `fn()` as gauges."""
+        self._collectors.append((prefix, fn))
+
+    def render(self):
+        """Everything in the Prometheus text exposition format."""
+        if self.directory is None:
+            snapshots = [self.snapshot()]
+        else:
+            snapshots = self._shared_snapshots()
+        stages, requests, slow, gauges = _merge(snapshots, len(self.buckets) + 1)
+
+        lines = []
+        self._render_histograms(lines, 'whatsapp_stage_seconds',
+                                "Time spent in each stage of the webhook and ingestion.",
+                                stages, ('stage', 'state'))
+        self._render_histograms(lines, 'whatsapp_request_seconds',
+                                "Total webhook request time by conversation state.",
+                                requests, ('endpoint', 'state'))
+        lines.append('# HELP whatsapp_slow_requests_total Requests slower than the slow-log threshold.')
+        lines.append('# TYPE whatsapp_slow_requests_total counter')
+        for (endpoint, state), count in sorted(slow.items()):
+            lines.append(f'whatsapp_slow_requests_total{{endpoint="{endpoint}",state="{state}"}} {count}')
+        for name, values in sorted(gauges.items()):
+            lines.append(f'# TYPE {name} gauge')
+            for pid, value in sorted(values):
+                labels = '' if self.directory is None else f'{{pid="{pid}"}}'
+                lines.append(f'{name}{labels} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """This process's histograms, slow-request counts and gauges, as JSON-able lists."""
+        def histograms(table):
+            return [[*key, *histogram.snapshot()] for key, histogram in list(table.items())]
+
+        with self._lock:
+            slow = [[*key, count] for key, count in self._slow.items()]
+        gauges = []
+        for prefix, fn in self._collectors:
+            try:
+                values = fn()
+            except Exception:
+                logger.exception("Metrics collector %s failed", prefix)
+                continue
+            gauges.extend([f'{prefix}_{name}', value] for name, value in values.items()
+                          if isinstance(value, (int, float)) and not isinstance(value, bool))
+        return {
+            'pid': os.getpid(),
+            'stages': histograms(self._stages),
+            'requests': histograms(self._requests),
+            'slow': slow,
+            'gauges': gauges,
+        }
+
+    def flush(self):
+        """Write this process's snapshot to the shared directory and return it."""
+        self._ensure_flusher()
+        snapshot = self.snapshot()
+        tmp_path = self._snapshot_path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self._snapshot_path)
+        except OSError:
+            logger.exception("Could not write metrics snapshot %s", self._snapshot_path)
+        return snapshot
+
+    def _shared_snapshots(self):
+        # Our own from memory, even if the file could not be written.
+        snapshots = [self.flush()]
+        for path in glob.glob(os.path.join(self.directory, 'metrics-*.json')):
+            if path == self._snapshot_path:
+                continue
+            try:
+                with open(path) as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                # Removed by a restarting server, or not a snapshot.
+                continue
+            if not _alive(snapshot['pid']):
+                snapshot['gauges'] = []
+            snapshots.append(snapshot)
+        return snapshots
+
+    def _ensure_flusher(self):
+        # Like the profile writer, started in whichever process first needs
+        # it, i.e. after gunicorn has forked. The file name is unique per
+        # process even if a later worker is given the same pid.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            self._snapshot_path = os.path.join(
+                self.directory, f"metrics-{os.getpid()}-{time.time():.6f}.json")
+            self._pid = os.getpid()
+        threading.Thread(target=self._flush_periodically, name='metrics-flusher',
+                         daemon=True).start()
+        atexit.register(self.flush)
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_seconds)
+            self.flush()
+
+    def _histogram(self, table, key):
+        with self._lock:
+            histogram = table.get(key)
+            if histogram is None:
+                histogram = table[key] = Histogram(self.buckets)
+            return histogram
+
+    def _finish_request(self, trace, elapsed):
+        key = (trace.endpoint, trace.state)
+        histogram = self._requests.get(key)
+        if histogram is None:
+            histogram = self._histogram(self._requests, key)
+        histogram.observe(elapsed)
+        if self.directory is not None and self._pid != os.getpid():
+            self._ensure_flusher()
+
+        if self.slow_seconds is not None and elapsed >= self.slow_seconds:
+            with self._lock:
+                self._slow[key] = self._slow.get(key, 0) + 1
+            breakdown = ', '.join(f"{stage}={seconds * 1000:.1f}ms"
+                                  for stage, seconds in trace.stages)
+            logger.warning("Slow %s request: %.1fms in state %r (%s)",
+                           trace.endpoint, elapsed * 1000, trace.state, breakdown)
+
+    def _render_histograms(self, lines, name, help_text, table, label_names):
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        for key, (counts, total, count) in sorted(table.items()):
+            labels = ','.join(f'{label}="{value}"' for label, value in zip(label_names, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'{name}_sum{{{labels}}} {total}')
+            lines.append(f'{name}_count{{{labels}}} {count}')
+
+
+def _merge(snapshots, n_buckets):
+    """Add up the histograms and counters of several snapshots."""
+    stages, requests, slow, gauges = {}, {}, {}, {}
+    for snapshot in snapshots:
+        for table, rows in ((stages, snapshot['stages']), (requests, snapshot['requests'])):
+            for label_a, label_b, counts, total, count in rows:
+                if len(counts) != n_buckets:
+                    # Written with other buckets; can't be added up.
+                    continue
+                merged = table.setdefault((label_a, label_b), [[0] * n_buckets, 0.0, 0])
+                merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                merged[1] += total
+                merged[2] += count
+        for endpoint, state, count in snapshot['slow']:
+            slow[(endpoint, state)] = slow.get((endpoint, state), 0) + count
+        for name, value in snapshot['gauges']:
+            gauges.setdefault(name, []).append((snapshot['pid'], value))
+    return stages, requests, slow, gauges
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def clear_metrics_dir(directory):
+    """Remove the snapshots of an earlier server from `directory`."""
+    for path in glob.glob(os.path.join(directory, 'metrics-*.json*')):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class _Sample:
+    __slots__ = ('_profiler', '_endpoint', '_cprofile')
+
+    def __init__(self, profiler, endpoint):
+        self._profiler = profiler
+        self._endpoint = endpoint
+
+    def __enter__(self):
+        self._cprofile = cProfile.Profile()
+        self._cprofile.enable()
+        return self
+
+    def __exit__(self, *exc):
+        self._cprofile.disable()
+        self._profiler._finish(self._endpoint, self._cprofile)
+        return False
+
+
+class SamplingProfiler:
+    """Runs cProfile on a random share of requests.
+
+    Only for the threaded sync app: cProfile hooks a whole thread, so
+    requests interleaved on one event loop would corrupt each other's
+    profiles. One request per process is profiled at a time. Profiles are
+    written to `directory` by a background thread, at most `max_files` per
+    process; samples beyond that, or while the writer is behind, are
+    dropped.
+    """
+
+    def __init__(self, rate, directory, max_files=100):
+        if rate and not directory:
+            raise ValueError("A profile directory is required when profiling is enabled")
+        self.rate = rate
+        self.directory = directory
+        self.max_files = max_files
+        self._active = threading.Lock()
+        self._lock = threading.Lock()
+        self._pending = queue.Queue(maxsize=4)
+        self._taken = 0
+        self._pid = None
+
+    def sample(self, endpoint):
+        """Context manager around one request; profiles it if it is sampled."""
+        if not self.rate or self._taken >= self.max_files or random.random() >= self.rate:
+            return _NOT_SAMPLED
+        if not self._active.acquire(blocking=False):
+            return _NOT_SAMPLED
+        return _Sample(self, endpoint)
+
+    def _finish(self, endpoint, cprofile):
+        self._active.release()
+        self._ensure_writer()
+        with self._lock:
+            if self._taken >= self.max_files:
+                return
+            try:
+                self._pending.put_nowait((endpoint, cprofile))
+            except queue.Full:
+                return
+            self._taken += 1
+
+    def _ensure_writer(self):
+        # Like the ingest workers, the writer thread is started in whichever
+        # process samples first, i.e. after gunicorn has forked.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self._write, name='profile-writer', daemon=True).start()
+                self._pid = os.getpid()
+
+    def _write(self):
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            endpoint, cprofile = self._pending.get()
+            path = os.path.join(self.directory,
+                                f"{endpoint}-{os.getpid()}-{time.time():.6f}.prof")
+            try:
+                cprofile.dump_stats(path)
+            except OSError:
+                logger.exception("Could not write profile %s", path)
+
+
+_NOT_SAMPLED = contextlib.nullcontext()
+
+
+def state_label(state):
+    """Conversation state name for metric labels."""
+    if state is None:
+        return ''
+    return state if isinstance(state, str) else state.get('state', '')
+
+
+def metrics_from_env():
+    # An empty SLOW_REQUEST_SECONDS turns slow-request logging off.
+    slow_seconds = os.getenv('SLOW_REQUEST_SECONDS', '2.0')
+    return Metrics(
+        slow_seconds=float(slow_seconds) if slow_seconds else None,
+        # Set by gunicorn.conf.py; unset, /metrics covers only the worker serving it.
+        directory=os.getenv('METRICS_DIR') or None,
+        flush_seconds=float(os.getenv('METRICS_FLUSH_SECONDS', 5.0)),
+    )
+
+
+def profiler_from_env():
+    return SamplingProfiler(
+        rate=float(os.getenv('PROFILE_SAMPLE_RATE', 0.0)),
+        directory=os.getenv('PROFILE_DIR'),
+        max_files=int(os.getenv('PROFILE_MAX_FILES', 100)),
+    )
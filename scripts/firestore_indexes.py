@@ -0,0 +1,51 @@
+"""Print the Firestore composite index definitions the bot's queries need.
+
+Write the output to firestore.indexes.json and deploy it with
+
+    firebase deploy --only firestore:indexes
+"""
+import argparse
+import json
+
+INDEXES = [
+    # "Receive docs": where(type ==).where(user ==).order_by(created desc).limit(1)
+    {'collection': 'documents', 'fields': [('user', 'ASCENDING'), ('type', 'ASCENDING'),
+                                           ('created', 'DESCENDING')]},
+    # "Receive docs" for records older than the created field: the same without order_by
+    {'collection': 'documents', 'fields': [('user', 'ASCENDING'), ('type', 'ASCENDING')]},
+    # Deduplication: where(content_hash ==).where(type ==).where(user ==).limit(1)
+    {'collection': 'documents', 'fields': [('user', 'ASCENDING'), ('type', 'ASCENDING'),
+                                           ('content_hash', 'ASCENDING')]},
+]
+
+
+def index_definitions():
+    return {
+        'indexes': [
+            {
+                'collectionGroup': index['collection'],
+                'queryScope': 'COLLECTION',
+                'fields': [{'fieldPath': path, 'order': order}
+                           for path, order in index['fields']],
+            }
+            for index in INDEXES
+        ],
+        'fieldOverrides': [],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-o', '--output', help="write to this file instead of stdout")
+    args = parser.parse_args()
+
+    text = json.dumps(index_definitions(), indent=2) + '\n'
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        print(text, end='')
+
+
+if __name__ == '__main__':
+    main()
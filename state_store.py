@@ -0,0 +1,211 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class StateStore:
+    """Conversation state keyed by the sender's WhatsApp number.
+
+    States are JSON-serialisable values (a string or a small dict). Every
+    write refreshes the entry's TTL; expired entries read as missing. A
+    `new` value of None in `set()`/`transition()` deletes the entry.
+    Backends that do I/O set `blocking`, so async callers know to run
+    them off the event loop.
+    """
+
+    blocking = True
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        self.set(key, None)
+
+    def transition(self, key, expected, new, ttl=None):
+        """Atomically replace `expected` with `new`; return True on success."""
+        raise NotImplementedError
+
+
+class MemoryStateStore(StateStore):
+    """Process-local LRU store with per-entry expiry."""
+
+    blocking = False
+
+    def __init__(self, ttl=1800, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._set(key, value, ttl)
+
+    def transition(self, key, expected, new, ttl=None):
+        with self._lock:
+            if self._get(key) != expected:
+                return False
+            self._set(key, new, ttl)
+            return True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def _set(self, key, value, ttl):
+        if value is None:
+            self._entries.pop(key, None)
+            return
+        expires = time.monotonic() + (ttl if ttl is not None else self.ttl)
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+class SQLiteStateStore(StateStore):
+    """Store shared by every process on a node through a WAL-mode SQLite file.
+
+    `max_entries` is enforced on every write by evicting the entries
+    closest to expiry.
+    """
+
+    def __init__(self, path, ttl=1800, max_entries=100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._path = path
+        self._local = threading.local()
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS conversation_state '
+                '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)'
+            )
+            conn.execute(
+                'CREATE INDEX IF NOT EXISTS conversation_state_expires '
+                'ON conversation_state (expires)'
+            )
+            # Row count kept by triggers, so the cap can be checked on every
+            # write without a COUNT(*) scan.
+            conn.execute('CREATE TABLE IF NOT EXISTS conversation_state_count (n INTEGER NOT NULL)')
+            conn.execute(
+                'INSERT INTO conversation_state_count SELECT COUNT(*) FROM conversation_state '
+                'WHERE NOT EXISTS (SELECT 1 FROM conversation_state_count)'
+            )
+            conn.execute(
+                'CREATE TRIGGER IF NOT EXISTS conversation_state_inserted '
+                'AFTER INSERT ON conversation_state '
+                'BEGIN UPDATE conversation_state_count SET n = n + 1; END'
+            )
+            conn.execute(
+                'CREATE TRIGGER IF NOT EXISTS conversation_state_deleted '
+                'AFTER DELETE ON conversation_state '
+                'BEGIN UPDATE conversation_state_count SET n = n - 1; END'
+            )
+
+    def get(self, key):
+        row = self._conn().execute(
+            'SELECT value FROM conversation_state WHERE key = ? AND expires > ?',
+            (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl=None):
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            self._write(conn, key, value, ttl)
+
+    def transition(self, key, expected, new, ttl=None):
+        conn = self._conn()
+        with conn:
+            # Take the write lock before reading so no other process can
+            # slip a transition in between the compare and the set.
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute(
+                'SELECT value FROM conversation_state WHERE key = ? AND expires > ?',
+                (key, time.time())
+            ).fetchone()
+            current = json.loads(row[0]) if row else None
+            if current != expected:
+                return False
+            self._write(conn, key, new, ttl)
+            return True
+
+    def purge(self):
+        conn = self._conn()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            self._purge(conn)
+
+    def _write(self, conn, key, value, ttl):
+        if value is None:
+            conn.execute('DELETE FROM conversation_state WHERE key = ?', (key,))
+            return
+        expires = time.time() + (ttl if ttl is not None else self.ttl)
+        # An upsert rather than INSERT OR REPLACE: REPLACE deletes the old
+        # row without firing the delete trigger, which would skew the count.
+        conn.execute(
+            'INSERT INTO conversation_state (key, value, expires) VALUES (?, ?, ?) '
+            'ON CONFLICT (key) DO UPDATE SET value = excluded.value, expires = excluded.expires',
+            (key, json.dumps(value), expires)
+        )
+        if self._count(conn) > self.max_entries:
+            self._purge(conn)
+
+    def _count(self, conn):
+        return conn.execute('SELECT n FROM conversation_state_count').fetchone()[0]
+
+    def _purge(self, conn):
+        conn.execute('DELETE FROM conversation_state WHERE expires <= ?', (time.time(),))
+        excess = self._count(conn) - self.max_entries
+        if excess > 0:
+            # Entries closest to expiry are the least recently written.
+            conn.execute(
+                'DELETE FROM conversation_state WHERE key IN ('
+                'SELECT key FROM conversation_state ORDER BY expires LIMIT ?)',
+                (excess,)
+            )
+
+    def _conn(self):
+        # One connection per thread and per process: SQLite connections
+        # must not be carried across a gunicorn fork.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self._path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+
+def create_state_store(url=None, ttl=1800, max_entries=10000):
+    """Build a store from a URL: 'memory' or 'sqlite:///path/to/state.db'."""
+    url = url or 'memory'
+    if url == 'memory':
+        return MemoryStateStore(ttl=ttl, max_entries=max_entries)
+    if url.startswith('sqlite:///'):
+        return SQLiteStateStore(url[len('sqlite:///'):], ttl=ttl, max_entries=max_entries)
+    raise ValueError(f"Unsupported state store URL: {url}")
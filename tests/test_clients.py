@@ -0,0 +1,110 @@
+import importlib.util
+import os
+import sys
+import types
+
+from aiohttp.worker import GunicornUVLoopWebWorker, GunicornWebWorker
+
+import clients
+from clients import ProcessLocal, pooled_session
+
+
+class Client:
+    def __init__(self, n):
+        self.n = n
+
+
+def counting_factory():
+    built = []
+
+    def factory():
+        built.append(Client(len(built)))
+        return built[-1]
+    return factory, built
+
+
+def test_process_local_builds_once_and_proxies():
+    factory, built = counting_factory()
+    client = ProcessLocal(factory)
+    assert built == []
+    assert client.n == 0
+    assert client.get() is built[0]
+    assert len(built) == 1
+
+
+def test_process_local_rebuilds_after_a_fork(monkeypatch):
+    factory, built = counting_factory()
+    client = ProcessLocal(factory)
+    parent = client.get()
+    child_pid = os.getpid() + 1
+    monkeypatch.setattr(clients.os, 'getpid', lambda: child_pid)
+    child = client.get()
+    assert child is not parent
+    assert client.get() is child
+    assert len(built) == 2
+
+
+def test_process_local_set_pins_a_value_for_this_process(monkeypatch):
+    factory, built = counting_factory()
+    client = ProcessLocal(factory)
+    fake = Client('fake')
+    client.set(fake)
+    assert client.n == 'fake'
+    assert built == []
+    child_pid = os.getpid() + 1
+    monkeypatch.setattr(clients.os, 'getpid', lambda: child_pid)
+    assert client.n == 0
+
+
+def test_pooled_session_sizes_the_pool_and_retries_gets():
+    session = pooled_session(auth=('sid', 'token'), pool_size=7, retries=5, backoff=0.25)
+    assert session.auth == ('sid', 'token')
+    for url in ('https://api.twilio.com/', 'http://127.0.0.1/'):
+        adapter = session.get_adapter(url)
+        assert adapter._pool_connections == 7
+        assert adapter._pool_maxsize == 7
+        retry = adapter.max_retries
+        assert retry.total == 5
+        assert retry.backoff_factor == 0.25
+        assert set(retry.status_forcelist) == {429, 500, 502, 503, 504}
+        assert retry.allowed_methods == frozenset(['GET', 'HEAD'])
+        assert not retry.raise_on_status
+
+
+def load_gunicorn_conf():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gunicorn.conf.py')
+    spec = importlib.util.spec_from_file_location('gunicorn_conf', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_warmup_runs_only_in_sync_workers(monkeypatch):
+    warmed = []
+    monkeypatch.setitem(sys.modules, 'app',
+                        types.SimpleNamespace(warmup=lambda: warmed.append(True)))
+    conf = load_gunicorn_conf()
+
+    conf.post_worker_init(object.__new__(GunicornWebWorker))
+    conf.post_worker_init(object.__new__(GunicornUVLoopWebWorker))
+    assert warmed == []
+    conf.post_worker_init(types.SimpleNamespace())
+    assert warmed == [True]
+
+
+def test_each_server_gets_an_empty_metrics_dir(monkeypatch, tmp_path):
+    conf = load_gunicorn_conf()
+    monkeypatch.delenv('METRICS_DIR', raising=False)
+    conf.on_starting(None)
+    created = os.environ['METRICS_DIR']
+    assert os.path.isdir(created) and not os.listdir(created)
+    conf.on_exit(None)
+    assert not os.path.exists(created)
+
+    stale = tmp_path / 'metrics-1-0.json'
+    stale.write_text('{}')
+    monkeypatch.setenv('METRICS_DIR', str(tmp_path))
+    conf = load_gunicorn_conf()
+    conf.on_starting(None)
+    conf.on_exit(None)
+    assert tmp_path.is_dir() and not stale.exists()
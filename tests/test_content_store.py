@@ -0,0 +1,90 @@
+import io
+import random
+
+import pytest
+
+import content_store
+from content_store import ContentStats, content_filename, recompress_image
+
+Image = pytest.importorskip('PIL.Image')
+
+ORIENTATION = 0x0112
+
+
+def photo(width, height, orientation=None):
+    rng = random.Random(0)
+    image = Image.new('RGB', (width, height))
+    image.putdata([(rng.randrange(256), rng.randrange(256), rng.randrange(256))
+                   for _ in range(width * height)])
+    exif = Image.Exif()
+    if orientation is not None:
+        exif[ORIENTATION] = orientation
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=95, exif=exif)
+    out.seek(0)
+    return out
+
+
+def test_content_filename_is_content_addressed():
+    assert content_filename('PAN Card', 'abc123', 'image/jpeg') == 'pan_card_abc123.jpeg'
+
+
+def test_recompress_downscales_and_rewinds():
+    original = photo(400, 300)
+    out, size = recompress_image(original, 'image/jpeg', max_dimension=200, quality=70)
+    assert original.tell() == 0
+    assert size == len(out.getvalue()) < len(original.getvalue())
+    assert Image.open(out).size == (200, 150)
+
+
+def test_recompress_applies_exif_orientation():
+    # Orientation 6: the camera was held upright, the sensor stored it sideways.
+    out, size = recompress_image(photo(400, 300, orientation=6), 'image/jpeg',
+                                 max_dimension=200, quality=70)
+    with Image.open(out) as image:
+        assert image.size == (150, 200)
+        assert ORIENTATION not in image.getexif()
+
+
+def test_recompress_skips_decompression_bombs(monkeypatch):
+    monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', 1000)
+    original = photo(400, 300)
+    assert recompress_image(original, 'image/jpeg') is None
+    assert original.tell() == 0
+
+
+def test_recompress_skips_unsupported_and_undecodable_files():
+    assert recompress_image(io.BytesIO(b'%PDF-1.4'), 'application/pdf') is None
+    assert recompress_image(io.BytesIO(b'not a jpeg'), 'image/jpeg') is None
+
+
+def test_content_stats():
+    stats = ContentStats()
+    stats.record_stored(1000, 400)
+    stats.record_duplicate(500)
+    assert stats.stats() == {
+        'lookups': 2, 'duplicates': 1, 'dedup_hit_rate': 0.5,
+        'bytes_received': 1500, 'bytes_stored': 400,
+        'dedup_bytes_saved': 500, 'compression_bytes_saved': 600,
+    }
+
+
+def test_recompress_decodes_large_jpegs_at_reduced_scale(monkeypatch):
+    decoded = []
+    transpose = content_store.ImageOps.exif_transpose
+
+    def spy(image):
+        decoded.append(image.size)
+        return transpose(image)
+
+    monkeypatch.setattr(content_store.ImageOps, 'exif_transpose', spy)
+    image = Image.new('RGB', (4000, 3000), 'white')
+    exif = Image.Exif()
+    exif[ORIENTATION] = 6
+    original = io.BytesIO()
+    image.save(original, 'JPEG', exif=exif)
+    original.seek(0)
+
+    out, _ = recompress_image(original, 'image/jpeg', max_dimension=500)
+    assert decoded == [(1000, 750)]
+    assert Image.open(out).size == (375, 500)
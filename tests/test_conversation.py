@@ -0,0 +1,32 @@
+from conversation import ingest_report
+
+MAX_BYTES = 25 * 1024 * 1024
+
+
+def job(*statuses):
+    return {
+        'doc_type': 'Form 16',
+        'media': [{}] * len(statuses),
+        'results': {i: status for i, status in enumerate(statuses) if status is not None},
+    }
+
+
+def test_single_attachment_reports():
+    assert ingest_report(job('saved'), MAX_BYTES) == "Form 16 received and saved."
+    assert "already saved earlier" in ingest_report(job('duplicate'), MAX_BYTES)
+    assert ingest_report(job('too_large'), MAX_BYTES) == "Your Form 16 is too large. The limit is 25 MB."
+    assert ingest_report(job('failed'), MAX_BYTES) == "Failed to save your Form 16. Please send it again."
+
+
+def test_attachment_without_a_result_counts_as_failed():
+    assert ingest_report(job(None), MAX_BYTES) == "Failed to save your Form 16. Please send it again."
+
+
+def test_multiple_attachments_report_each_problem():
+    report = ingest_report(job('saved', 'duplicate', 'too_large', 'failed'), MAX_BYTES)
+    assert report.split('\n') == [
+        "2 of 4 Form 16 files saved.",
+        "File 2: already saved earlier.",
+        "File 3: too large. The limit is 25 MB.",
+        "File 4: failed. Please send it again.",
+    ]
@@ -0,0 +1,126 @@
+import asyncio
+
+import pytest
+
+from benchmarks.fakes import FakeFirestore
+from document_index import AsyncDocumentIndex, DocumentIndex
+from state_store import SQLiteStateStore
+
+USER = 'whatsapp:+15550000001'
+
+
+def add(db, doc_type, url, created=None, user=USER, content_hash=None):
+    record = {'type': doc_type, 'url': url, 'user': user}
+    if created is not None:
+        record['created'] = created
+    if content_hash is not None:
+        record['content_hash'] = content_hash
+    db.collection('documents').add(record)
+
+
+@pytest.fixture
+def db():
+    db = FakeFirestore()
+    add(db, 'PAN Card', 'pan-old', created=1.0)
+    add(db, 'PAN Card', 'pan-new', created=2.0)
+    add(db, 'Aadhar Card', 'aadhar', created=1.5, content_hash='abc')
+    add(db, 'Form 16', 'form16', user='whatsapp:+15550000002')
+    return db
+
+
+def test_all_for_is_served_from_the_cache(db):
+    index = DocumentIndex(db)
+    assert sorted(d['url'] for d in index.all_for(USER)) == ['aadhar', 'pan-new', 'pan-old']
+    index.all_for(USER)
+    assert db.reads == 1
+    assert index.stats()['hits'] == 1
+
+
+def test_first_of_type_returns_the_newest_and_fills_the_cache(db):
+    index = DocumentIndex(db)
+    assert index.first_of_type(USER, 'PAN Card')['url'] == 'pan-new'
+    assert index.first_of_type(USER, 'PAN Card')['url'] == 'pan-new'
+    assert index.first_of_type(USER, 'Form 16') is None
+    assert index.first_of_type(USER, 'Form 16') is None
+    assert index.stats()['hits'] == 2
+    reads = db.reads
+
+    index.all_for(USER)
+    assert index.first_of_type(USER, 'PAN Card')['url'] == 'pan-new'
+    assert db.reads == reads + 1
+
+
+def test_first_of_type_finds_records_without_created(db):
+    add(db, 'Form 16', 'legacy-form16')
+    index = DocumentIndex(db)
+    assert index.first_of_type(USER, 'Form 16')['url'] == 'legacy-form16'
+
+
+def test_invalidate_drops_the_cached_records(db):
+    index = DocumentIndex(db)
+    index.all_for(USER)
+    add(db, 'PAN Card', 'pan-newest', created=3.0)
+    index.invalidate(USER)
+    assert 'pan-newest' in [d['url'] for d in index.all_for(USER)]
+    assert index.first_of_type(USER, 'PAN Card')['url'] == 'pan-newest'
+
+
+def test_invalidate_reaches_other_processes_through_a_shared_store(db, tmp_path):
+    versions = str(tmp_path / 'state.db')
+    worker_a = DocumentIndex(db, versions=SQLiteStateStore(versions))
+    worker_b = DocumentIndex(db, versions=SQLiteStateStore(versions))
+    worker_b.all_for(USER)
+    worker_b.first_of_type(USER, 'PAN Card')
+
+    add(db, 'PAN Card', 'pan-newest', created=3.0)
+    worker_a.invalidate(USER)
+    assert 'pan-newest' in [d['url'] for d in worker_b.all_for(USER)]
+    assert worker_b.first_of_type(USER, 'PAN Card')['url'] == 'pan-newest'
+
+
+def test_find_by_hash_always_queries(db):
+    index = DocumentIndex(db)
+    index.all_for(USER)
+    assert index.find_by_hash(USER, 'Aadhar Card', 'abc')['url'] == 'aadhar'
+    add(db, 'PAN Card', 'pan-hashed', content_hash='def')
+    assert index.find_by_hash(USER, 'PAN Card', 'def')['url'] == 'pan-hashed'
+    assert index.find_by_hash(USER, 'PAN Card', 'abc') is None
+    assert db.reads == 4
+
+
+class AsyncFirestore:
+    """Wraps FakeFirestore so query streams are async iterators."""
+
+    def __init__(self, db):
+        self._db = db
+
+    def collection(self, name):
+        return AsyncQuery(self._db.collection(name))
+
+
+class AsyncQuery:
+    def __init__(self, query):
+        self._query = query
+
+    def __getattr__(self, name):
+        method = getattr(self._query, name)
+        return lambda *args, **kwargs: AsyncQuery(method(*args, **kwargs))
+
+    async def stream(self):
+        for doc in self._query.stream():
+            yield doc
+
+
+def test_async_index(db, tmp_path):
+    async def main():
+        index = AsyncDocumentIndex(AsyncFirestore(db),
+                                   versions=SQLiteStateStore(str(tmp_path / 'state.db')))
+        first = await index.first_of_type(USER, 'PAN Card')
+        add(db, 'PAN Card', 'pan-newest', created=3.0)
+        cached = await index.first_of_type(USER, 'PAN Card')
+        await index.invalidate(USER)
+        fresh = await index.first_of_type(USER, 'PAN Card')
+        found = await index.find_by_hash(USER, 'Aadhar Card', 'abc')
+        return first['url'], cached['url'], fresh['url'], found['url']
+
+    assert asyncio.run(main()) == ('pan-new', 'pan-new', 'pan-newest', 'aadhar')
@@ -0,0 +1,64 @@
+import pytest
+
+from conversation import build_flow
+from flow import END, FlowEngine
+
+MENUS = {'fruit': ['Apple', 'Pear']}
+
+
+def dispatch(engine, state, text, has_media=False):
+    replies = []
+    next_state = engine.dispatch(state, text, has_media, replies.append,
+                                 from_number='whatsapp:+10000000000', values={})
+    return replies, next_state
+
+
+def test_choices_expand_into_options():
+    engine = FlowEngine({
+        'pick': {'choices': ('fruit', {'reply': "You picked {choice}.",
+                                       'next': {'state': 'done', 'fruit': '{choice}'}})},
+        'done': {'any': {'reply': "Bye.", 'next': END}},
+    }, MENUS, start='pick', error_reply="Error.")
+
+    assert dispatch(engine, 'pick', '2') == (["You picked Pear."],
+                                             {'state': 'done', 'fruit': 'Pear'})
+    assert dispatch(engine, {'state': 'done'}, 'x') == (["Bye."], None)
+    assert dispatch(engine, 'nowhere', 'x') == (["Error."], 'nowhere')
+
+
+def test_choice_colliding_with_an_option_is_rejected():
+    with pytest.raises(ValueError, match="choice 2"):
+        FlowEngine({
+            'pick': {'options': {'2': {'reply': "Two."}},
+                     'choices': ('fruit', {'reply': "{choice}"})},
+        }, MENUS, start='pick', error_reply="Error.")
+
+
+def test_unknown_target_state_is_rejected():
+    with pytest.raises(ValueError, match="unknown state 'gone'"):
+        FlowEngine({'pick': {'any': {'next': 'gone'}}}, MENUS, start='pick', error_reply="Error.")
+
+
+def test_unregistered_actions_fail_the_check():
+    engine = build_flow()
+    engine.action('show_all_documents')(lambda turn: None)
+    with pytest.raises(ValueError, match="queue_document, receive_document"):
+        engine.check_actions()
+
+    engine.action('queue_document')(lambda turn: None)
+    engine.action('receive_document')(lambda turn, doc_type: None)
+    engine.check_actions()
+
+
+def test_actions_receive_the_turn_and_params():
+    engine = build_flow()
+    seen = []
+
+    @engine.action('receive_document')
+    def receive_document(turn, doc_type):
+        seen.append((turn.from_number, doc_type))
+        turn.reply(f"Here is your {doc_type}.")
+
+    replies, next_state = dispatch(engine, 'waiting_for_receive_document_type', '2')
+    assert seen == [('whatsapp:+10000000000', 'PAN Card')]
+    assert (replies, next_state) == (["Here is your PAN Card."], None)
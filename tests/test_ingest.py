@@ -0,0 +1,215 @@
+import asyncio
+import threading
+
+import pytest
+
+import ingest
+from ingest import AsyncIngestQueue, IdempotencyStore, IngestQueue, QueueFull
+
+
+def job(sid):
+    return {'message_sid': sid}
+
+
+class Flaky:
+    """Handler that fails `failures` times before succeeding."""
+
+    def __init__(self, failures, exc=RuntimeError):
+        self.failures = failures
+        self.exc = exc
+        self.calls = 0
+
+    def __call__(self, job):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise self.exc(f"attempt {self.calls}")
+        return 'stored'
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(ingest.time, 'sleep', delays.append)
+    return delays
+
+
+def test_retries_with_exponential_backoff(sleeps):
+    handler = Flaky(2)
+    settled = []
+    q = IngestQueue(handler, workers=0, max_attempts=3, backoff=0.5,
+                    on_success=lambda job, result: settled.append(result))
+
+    assert q.submit(job('SM1'))
+    assert handler.calls == 3
+    assert sleeps == [0.5, 1.0]
+    assert settled == ['stored']
+    assert q.status('SM1') == 'done'
+
+
+def test_gives_up_after_max_attempts(sleeps):
+    handler = Flaky(5)
+    failures = []
+    q = IngestQueue(handler, workers=0, max_attempts=3, backoff=0.5,
+                    on_failure=lambda job, exc: failures.append(str(exc)))
+
+    q.submit(job('SM1'))
+    assert handler.calls == 3
+    assert failures == ['attempt 3']
+    assert q.status('SM1') == 'failed'
+
+
+def test_fatal_errors_are_not_retried(sleeps):
+    handler = Flaky(5, exc=ValueError)
+    q = IngestQueue(handler, workers=0, max_attempts=3, fatal=(ValueError,))
+
+    q.submit(job('SM1'))
+    assert handler.calls == 1
+    assert sleeps == []
+    assert q.status('SM1') == 'failed'
+
+
+def test_same_message_sid_is_ingested_once():
+    handler = Flaky(0)
+    q = IngestQueue(handler, workers=0)
+
+    assert q.submit(job('SM1'))
+    assert not q.submit(job('SM1'))
+    assert handler.calls == 1
+
+
+def test_idempotency_is_shared_through_the_database_file(tmp_path):
+    path = str(tmp_path / 'ingest.db')
+    first = IngestQueue(Flaky(0), workers=0, seen=IdempotencyStore(path))
+    second = IngestQueue(Flaky(0), workers=0, seen=IdempotencyStore(path))
+
+    assert first.submit(job('SM1'))
+    assert not second.submit(job('SM1'))
+    assert second.status('SM1') == 'done'
+
+
+def test_full_queue_raises_and_releases_the_sid():
+    started = threading.Event()
+    release = threading.Event()
+
+    def handler(job):
+        started.set()
+        release.wait(5)
+
+    q = IngestQueue(handler, workers=1, max_depth=1)
+    q.submit(job('SM1'))
+    assert started.wait(5)
+    q.submit(job('SM2'))
+    with pytest.raises(QueueFull):
+        q.submit(job('SM3'))
+    assert q.status('SM3') is None
+
+    release.set()
+    q.join()
+    assert q.submit(job('SM3'))
+    q.join()
+    assert q.status('SM3') == 'done'
+
+
+def test_async_queue_retries_and_deduplicates():
+    calls = []
+    settled = []
+
+    async def handler(job):
+        calls.append(job['message_sid'])
+        if len(calls) == 1:
+            raise RuntimeError("first attempt")
+        return 'stored'
+
+    async def on_success(job, result):
+        settled.append(result)
+
+    async def main():
+        q = AsyncIngestQueue(handler, workers=1, backoff=0, on_success=on_success)
+        q.start()
+        assert await q.submit(job('SM1'))
+        assert not await q.submit(job('SM1'))
+        await q.join()
+        await q.stop()
+        return await q.status('SM1')
+
+    assert asyncio.run(main()) == 'done'
+    assert calls == ['SM1', 'SM1']
+    assert settled == ['stored']
+
+
+def test_async_queue_full():
+    async def handler(job):
+        pass
+
+    async def main():
+        q = AsyncIngestQueue(handler, max_depth=1)
+        await q.submit(job('SM1'))
+        with pytest.raises(QueueFull):
+            await q.submit(job('SM2'))
+        return await q.status('SM2')
+
+    assert asyncio.run(main()) is None
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ingest.time, 'time', clock)
+    return clock
+
+
+def test_stale_pending_claim_can_be_claimed_again(clock):
+    seen = IdempotencyStore(stale_after=60)
+    assert seen.claim('SM1')
+    clock.now += 59
+    assert not seen.claim('SM1')
+    clock.now += 2
+    assert seen.claim('SM1')
+    # Reclaiming refreshes the claim, so only one worker gets it.
+    assert not seen.claim('SM1')
+
+
+def test_settled_claims_never_go_stale(clock):
+    seen = IdempotencyStore(stale_after=60)
+    seen.claim('SM1')
+    seen.mark('SM1', 'done')
+    clock.now += 3600
+    assert not seen.claim('SM1')
+    assert seen.status('SM1') == 'done'
+
+
+def test_old_claims_are_pruned(clock):
+    seen = IdempotencyStore(retention=3600)
+    seen.claim('SM1')
+    seen.mark('SM1', 'done')
+    clock.now += 3601
+    seen.claim('SM2')
+    assert seen.status('SM1') is None
+    assert seen.status('SM2') == 'pending'
+
+
+def test_async_stop_releases_unfinished_jobs():
+    started = asyncio.Event()
+
+    async def handler(job):
+        started.set()
+        await asyncio.sleep(60)
+
+    async def main():
+        q = AsyncIngestQueue(handler, workers=1)
+        q.start()
+        await q.submit(job('SM1'))
+        await q.submit(job('SM2'))
+        await started.wait()
+        await q.stop()
+        return await q.status('SM1'), await q.status('SM2'), q.depth()
+
+    assert asyncio.run(main()) == (None, None, 0)
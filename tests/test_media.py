@@ -0,0 +1,81 @@
+import asyncio
+import hashlib
+import io
+
+import aiohttp
+import pytest
+
+from benchmarks.fakes import MediaServer
+from media import MediaDownloadError, MediaTooLarge, fetch_media_async, spool_media
+
+KB = 1024
+
+
+def test_spool_media_hashes_and_rewinds():
+    with MediaServer(300 * KB) as server:
+        spool, size, digest = spool_media(server.url, None, chunk_size=64 * KB)
+    with spool:
+        data = spool.read()
+    assert size == len(data) == 300 * KB
+    assert digest == hashlib.sha256(data).hexdigest()
+
+
+def test_spool_media_spills_large_media_to_disk():
+    with MediaServer(300 * KB) as server:
+        small, _, _ = spool_media(server.url, None, spool_bytes=1024 * KB)
+        large, _, _ = spool_media(server.url, None, spool_bytes=100 * KB)
+    with small, large:
+        assert not small._rolled
+        assert large._rolled
+
+
+def test_spool_media_rejects_declared_length_over_the_limit():
+    with MediaServer(300 * KB) as server:
+        with pytest.raises(MediaTooLarge, match="is 307200 bytes"):
+            spool_media(server.url, None, max_bytes=100 * KB)
+
+
+def test_spool_media_aborts_mid_stream_without_a_length():
+    with MediaServer(300 * KB, content_length=False) as server:
+        with pytest.raises(MediaTooLarge, match="exceeds"):
+            spool_media(server.url, None, chunk_size=16 * KB, max_bytes=100 * KB)
+
+
+def test_spool_media_reports_http_errors():
+    with MediaServer(10, status=404) as server:
+        with pytest.raises(MediaDownloadError, match="HTTP 404"):
+            spool_media(server.url, None)
+
+
+def fetch(server, max_bytes=None):
+    async def main():
+        fileobj = io.BytesIO()
+        hasher = hashlib.sha256()
+        async with aiohttp.ClientSession() as session:
+            size = await fetch_media_async(session, server.url, None, fileobj,
+                                           chunk_size=64 * KB, max_bytes=max_bytes,
+                                           hasher=hasher)
+        return size, fileobj.getvalue(), hasher.hexdigest()
+    return asyncio.run(main())
+
+
+def test_fetch_media_async_writes_and_hashes():
+    with MediaServer(300 * KB) as server:
+        size, data, digest = fetch(server)
+    assert size == len(data) == 300 * KB
+    assert digest == hashlib.sha256(data).hexdigest()
+
+
+def test_fetch_media_async_enforces_the_limit():
+    with MediaServer(300 * KB) as server:
+        with pytest.raises(MediaTooLarge, match="is 307200 bytes"):
+            fetch(server, max_bytes=100 * KB)
+    with MediaServer(300 * KB, content_length=False) as server:
+        with pytest.raises(MediaTooLarge, match="exceeds"):
+            fetch(server, max_bytes=100 * KB)
+
+
+def test_fetch_media_async_reports_http_errors():
+    with MediaServer(10, status=503) as server:
+        with pytest.raises(MediaDownloadError, match="HTTP 503"):
+            fetch(server)
@@ -0,0 +1,148 @@
+import logging
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import metrics as metrics_module
+from metrics import Metrics, SamplingProfiler, clear_metrics_dir, state_label
+
+WORKER = """
+from metrics import Metrics
+metrics = Metrics(directory={directory!r}, flush_seconds=3600)
+metrics.add_collector('whatsapp_ingest', lambda: {{'queue_depth': 7}})
+for _ in range(3):
+    with metrics.request('whatsapp') as trace:
+        trace.state = 'greeting'
+"""
+
+
+def test_stage_and_request_histograms_render():
+    metrics = Metrics(slow_seconds=60)
+    with metrics.request('whatsapp') as trace:
+        trace.state = 'greeting'
+        with metrics.timer('dispatch', 'greeting'):
+            pass
+    metrics.add_collector('whatsapp_ingest', lambda: {'queue_depth': 3, 'name': 'x'})
+
+    text = metrics.render()
+    assert 'whatsapp_stage_seconds_count{stage="dispatch",state="greeting"} 1' in text
+    assert 'whatsapp_stage_seconds_bucket{stage="dispatch",state="greeting",le="+Inf"} 1' in text
+    assert 'whatsapp_request_seconds_count{endpoint="whatsapp",state="greeting"} 1' in text
+    assert 'whatsapp_ingest_queue_depth 3' in text
+    assert 'whatsapp_ingest_name' not in text
+
+
+def test_slow_requests_are_logged_with_their_stages(caplog):
+    metrics = Metrics(slow_seconds=0)
+    with caplog.at_level(logging.WARNING, logger='metrics'):
+        with metrics.request('whatsapp'):
+            with metrics.timer('state_lookup'):
+                pass
+    assert 'state_lookup=' in caplog.text
+    assert 'whatsapp_slow_requests_total{endpoint="whatsapp",state=""} 1' in metrics.render()
+
+
+def test_no_traces_without_slow_logging(monkeypatch):
+    metrics = Metrics(slow_seconds=None)
+    with metrics.request('whatsapp') as trace:
+        with metrics.timer('state_lookup'):
+            pass
+    assert trace.stages == []
+    assert 'whatsapp_stage_seconds_count{stage="state_lookup",state=""} 1' in metrics.render()
+
+    monkeypatch.setenv('SLOW_REQUEST_SECONDS', '')
+    assert metrics_module.metrics_from_env().slow_seconds is None
+
+
+def test_histogram_folds_observations_in_batches():
+    histogram = metrics_module.Histogram(bounds=(1.0,))
+    for _ in range(metrics_module.FOLD_AT - 1):
+        histogram.observe(0.5)
+    assert histogram.count == 0
+    histogram.observe(2.0)
+    assert histogram.count == metrics_module.FOLD_AT
+    histogram.observe(0.5)
+    assert histogram.snapshot() == ([metrics_module.FOLD_AT, 1], 0.5 * metrics_module.FOLD_AT + 2.0,
+                                    metrics_module.FOLD_AT + 1)
+
+
+def test_render_adds_up_every_process_in_the_directory(tmp_path):
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    # A worker that served three requests and exited; it flushes on exit.
+    subprocess.run([sys.executable, '-c', WORKER.format(directory=str(tmp_path))],
+                   cwd=root, check=True)
+
+    metrics = Metrics(directory=str(tmp_path))
+    metrics.add_collector('whatsapp_ingest', lambda: {'queue_depth': 2})
+    with metrics.request('whatsapp') as trace:
+        trace.state = 'greeting'
+
+    text = metrics.render()
+    assert 'whatsapp_request_seconds_count{endpoint="whatsapp",state="greeting"} 4' in text
+    assert text.count('whatsapp_request_seconds_bucket{endpoint="whatsapp",state="greeting",'
+                      'le="+Inf"} 4') == 1
+    # Gauges only for live processes.
+    gauges = [line for line in text.splitlines()
+              if line.startswith('whatsapp_ingest_queue_depth{')]
+    assert gauges == [f'whatsapp_ingest_queue_depth{{pid="{os.getpid()}"}} 2']
+
+    clear_metrics_dir(str(tmp_path))
+    assert 'state="greeting"} 1' in metrics.render()
+
+
+def test_snapshots_of_other_buckets_or_garbage_are_skipped(tmp_path):
+    other = Metrics(buckets=(1.0,), directory=str(tmp_path))
+    with other.timer('dispatch'):
+        pass
+    other.flush()
+    (tmp_path / 'metrics-1-0.json').write_text('{')
+
+    metrics = Metrics(directory=str(tmp_path))
+    with metrics.timer('dispatch'):
+        pass
+    assert 'whatsapp_stage_seconds_count{stage="dispatch",state=""} 1' in metrics.render()
+
+
+def test_state_label():
+    assert state_label(None) == ''
+    assert state_label('greeting') == 'greeting'
+    assert state_label({'state': 'waiting_for_document', 'doc_type': 'PAN Card'}) == \
+        'waiting_for_document'
+
+
+def test_profiler_needs_a_directory():
+    with pytest.raises(ValueError):
+        SamplingProfiler(rate=0.5, directory=None)
+    SamplingProfiler(rate=0.0, directory=None).sample('whatsapp').__enter__()
+
+
+def wait_for_files(directory, count):
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline:
+        if directory.exists() and len(list(directory.iterdir())) >= count:
+            break
+        time.sleep(0.01)
+    time.sleep(0.05)
+    return sorted(directory.iterdir())
+
+
+def test_profiler_writes_at_most_max_files(tmp_path):
+    profiler = SamplingProfiler(rate=1.0, directory=str(tmp_path / 'profiles'), max_files=2)
+    for _ in range(5):
+        with profiler.sample('whatsapp'):
+            sum(range(100))
+    files = wait_for_files(tmp_path / 'profiles', 2)
+    assert len(files) == 2
+    assert all(f.name.startswith('whatsapp-') and f.suffix == '.prof' for f in files)
+
+
+def test_profiler_skips_requests_that_overlap_a_sample(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics_module.random, 'random', lambda: 0.0)
+    profiler = SamplingProfiler(rate=0.5, directory=str(tmp_path))
+    with profiler.sample('whatsapp'):
+        assert profiler.sample('whatsapp') is metrics_module._NOT_SAMPLED
+    with profiler.sample('whatsapp') as sample:
+        assert sample is not None
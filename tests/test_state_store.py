@@ -0,0 +1,81 @@
+import pytest
+
+from state_store import MemoryStateStore, SQLiteStateStore, create_state_store
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryStateStore(ttl=60, max_entries=100)
+    return SQLiteStateStore(str(tmp_path / 'state.db'), ttl=60, max_entries=100)
+
+
+def test_set_get_delete(store):
+    state = {'state': 'waiting_for_document', 'doc_type': 'PAN Card'}
+    store.set('a', state)
+    assert store.get('a') == state
+    store.delete('a')
+    assert store.get('a') is None
+
+
+def test_expired_entries_read_as_missing(store):
+    store.set('a', 'waiting_for_action', ttl=0)
+    store.set('b', 'waiting_for_action')
+    assert store.get('a') is None
+    assert store.get('b') == 'waiting_for_action'
+
+
+def test_transition_compares_and_sets(store):
+    assert store.transition('a', None, 'waiting_for_action')
+    assert store.transition('a', 'waiting_for_action', 'waiting_for_document_type')
+    assert store.get('a') == 'waiting_for_document_type'
+
+    assert not store.transition('a', 'waiting_for_action', 'greeting')
+    assert store.get('a') == 'waiting_for_document_type'
+
+
+def test_transition_to_none_deletes(store):
+    store.set('a', 'waiting_for_action')
+    assert store.transition('a', 'waiting_for_action', None)
+    assert store.get('a') is None
+
+
+def test_transition_treats_expired_entries_as_missing(store):
+    store.set('a', 'waiting_for_action', ttl=0)
+    assert not store.transition('a', 'waiting_for_action', 'greeting')
+    assert store.transition('a', None, 'greeting')
+
+
+@pytest.mark.parametrize('kind', ['memory', 'sqlite'])
+def test_max_entries_is_enforced_on_every_write(kind, tmp_path):
+    if kind == 'memory':
+        store = MemoryStateStore(max_entries=3)
+    else:
+        store = SQLiteStateStore(str(tmp_path / 'state.db'), max_entries=3)
+    for i in range(250):
+        store.set(f"user{i}", 'waiting_for_action')
+        store.set(f"user{i}", 'waiting_for_document_type')
+    assert [store.get(f"user{i}") for i in range(245, 250)] == \
+        [None, None, 'waiting_for_document_type', 'waiting_for_document_type',
+         'waiting_for_document_type']
+    if kind == 'memory':
+        assert len(store) == 3
+    else:
+        conn = store._conn()
+        assert conn.execute('SELECT COUNT(*) FROM conversation_state').fetchone()[0] == 3
+
+
+def test_sqlite_store_is_shared_through_the_file(tmp_path):
+    path = str(tmp_path / 'state.db')
+    first = SQLiteStateStore(path)
+    second = SQLiteStateStore(path)
+    assert first.transition('a', None, 'waiting_for_action')
+    assert not second.transition('a', None, 'greeting')
+    assert second.get('a') == 'waiting_for_action'
+
+
+def test_create_state_store(tmp_path):
+    assert isinstance(create_state_store('memory'), MemoryStateStore)
+    assert isinstance(create_state_store(f"sqlite:///{tmp_path}/state.db"), SQLiteStateStore)
+    with pytest.raises(ValueError):
+        create_state_store('redis://localhost')
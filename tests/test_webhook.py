@@ -0,0 +1,178 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+import pytest
+
+import webhook
+from benchmarks.fakes import FakeFirestore
+from conversation import build_flow
+from media import MediaTooLarge
+from state_store import MemoryStateStore
+from webhook import (answer, answer_async, mark_saved, metrics, new_job, pending_media,
+                     reply_queued, settle, write_batch)
+
+
+def make_job(count):
+    return {
+        'message_sid': 'SM1',
+        'media': [{'url': f"https://media.example/{i}", 'content_type': 'image/jpeg'}
+                  for i in range(count)],
+        'doc_type': 'Aadhar Card',
+        'from_number': 'whatsapp:+15550000001',
+    }
+
+
+def record(content_hash):
+    return {'type': 'Aadhar Card', 'user': 'whatsapp:+15550000001',
+            'url': f"https://storage.example/{content_hash}", 'content_hash': content_hash}
+
+
+def test_identical_attachments_in_one_message_are_stored_once():
+    job = make_job(3)
+    pending = pending_media(job)
+    records, error = settle(job, pending, [record('abc'), record('abc'), record('def')])
+    assert error is None
+    assert sorted(records) == [0, 2]
+    assert job['results'] == {1: 'duplicate'}
+
+    db = FakeFirestore()
+    write_batch(db, job, records).commit()
+    mark_saved(job, records)
+    assert sorted(db.collection('documents').docs) == ['SM1', 'SM1_2']
+    assert job['results'] == {0: 'saved', 1: 'duplicate', 2: 'saved'}
+
+
+def test_retry_only_repeats_failed_attachments():
+    job = make_job(3)
+    failure = RuntimeError("upload failed")
+    records, error = settle(job, pending_media(job),
+                            [record('abc'), MediaTooLarge("too big"), failure])
+    mark_saved(job, records)
+    assert error is failure
+    assert job['results'] == {0: 'saved', 1: 'too_large', 2: 'failed'}
+    assert pending_media(job) == [(2, job['media'][2])]
+
+
+def test_cancellation_is_not_recorded_as_a_failure():
+    job = make_job(1)
+    with pytest.raises(asyncio.CancelledError):
+        settle(job, pending_media(job), [asyncio.CancelledError()])
+
+
+def media_message(sid):
+    return {'From': 'whatsapp:+15550000001', 'NumMedia': '1', 'MessageSid': sid,
+            'MediaUrl0': f"https://media.example/{sid}", 'MediaContentType0': 'image/jpeg'}
+
+
+def racing_flow(queued, during_dispatch):
+    """A flow whose queue_document runs `during_dispatch(sid)` mid-action."""
+    flow = build_flow()
+    flow.action('show_all_documents')(lambda turn: None)
+    flow.action('receive_document')(lambda turn, doc_type: None)
+
+    @flow.action('queue_document')
+    def queue_document(turn):
+        job = new_job(turn)
+        queued.append(job['message_sid'])
+        during_dispatch(job['message_sid'])
+        reply_queued(turn, job)
+
+    return flow
+
+
+def test_media_messages_racing_keep_their_replies():
+    # WhatsApp delivers several photos as separate messages at once: B is
+    # still dispatching when A has already moved the state on.
+    user = 'whatsapp:+15550000001'
+    store = MemoryStateStore()
+    store.set(user, {'state': 'waiting_for_document', 'doc_type': 'PAN Card'})
+    queued, replies = [], {}
+
+    def during_dispatch(sid):
+        if sid == 'SMB':
+            replies['SMA'] = send('SMA')
+
+    def send(sid):
+        with metrics.request('whatsapp') as trace:
+            return answer(flow, store, trace, user, '', True, media_message(sid))
+
+    flow = racing_flow(queued, during_dispatch)
+    replies['SMB'] = send('SMB')
+
+    assert queued == ['SMB', 'SMA']
+    assert 'PAN Card received, processing' in replies['SMA']
+    assert 'PAN Card received, processing' in replies['SMB']
+    assert 'How can I assist you' not in replies['SMB']
+    assert store.get(user) is None
+
+
+def test_reply_only_message_is_dispatched_again_after_a_lost_race():
+    user = 'whatsapp:+15550000001'
+
+    class Racing(MemoryStateStore):
+        def transition(self, key, expected, new, ttl=None):
+            if self.get(key) is None:
+                # Another 'hi' from the same user got there first.
+                self.set(key, 'waiting_for_action')
+            return super().transition(key, expected, new, ttl)
+
+    store = Racing()
+    flow = racing_flow([], lambda sid: None)
+    with metrics.request('whatsapp') as trace:
+        reply = answer(flow, store, trace, user, '1', False, {})
+
+    assert 'Which document do you want to send?' in reply
+    assert 'How can I assist you' not in reply
+    assert store.get(user) == 'waiting_for_document_type'
+
+
+def test_async_media_messages_racing_keep_their_replies():
+    user = 'whatsapp:+15550000001'
+    store = MemoryStateStore()
+    store.set(user, {'state': 'waiting_for_document', 'doc_type': 'PAN Card'})
+    flow = build_flow()
+    replies = {}
+
+    async def send(sid):
+        with metrics.request('whatsapp') as trace:
+            return await answer_async(flow, store, trace, user, '', True, media_message(sid))
+
+    async def noop(turn, **params):
+        pass
+
+    flow.action('show_all_documents')(noop)
+    flow.action('receive_document')(noop)
+
+    @flow.action('queue_document')
+    async def queue_document(turn):
+        job = new_job(turn)
+        if job['message_sid'] == 'SMB':
+            replies['SMA'] = await send('SMA')
+        reply_queued(turn, job)
+
+    replies['SMB'] = asyncio.run(send('SMB'))
+    assert 'PAN Card received, processing' in replies['SMA']
+    assert 'PAN Card received, processing' in replies['SMB']
+    assert store.get(user) is None
+
+
+def test_state_store_is_shared_between_workers_by_default(monkeypatch, tmp_path):
+    monkeypatch.delenv('STATE_STORE_URL', raising=False)
+    monkeypatch.setattr(webhook.tempfile, 'gettempdir', lambda: str(tmp_path))
+    first, second = webhook.state_store_from_env(), webhook.state_store_from_env()
+    first.set('whatsapp:+15550000001', 'waiting_for_action')
+    assert second.get('whatsapp:+15550000001') == 'waiting_for_action'
+    assert (tmp_path / 'whatsapp_state.db').exists()
+
+
+@pytest.mark.parametrize('chunk_size, ok', [('1048576', True), ('1000000', False), ('0', False)])
+def test_media_chunk_size_is_checked_at_startup(chunk_size, ok):
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    result = subprocess.run([sys.executable, '-c', 'import webhook'], cwd=root,
+                            env={**os.environ, 'MEDIA_CHUNK_SIZE': chunk_size},
+                            capture_output=True, text=True)
+    assert (result.returncode == 0) == ok
+    if not ok:
+        assert 'multiple of 262144' in result.stderr
@@ -0,0 +1,314 @@
+"""The parts of the /whatsapp webhook shared by app.py and async_app.py.
+
+Settings, Firestore records, per-attachment bookkeeping and the replies of
+the flow actions live here; each app only supplies its own (sync or async)
+I/O around them.
+"""
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+from dotenv import load_dotenv
+from twilio.twiml.messaging_response import MessagingResponse
+
+from content_store import ContentStats, content_filename, recompress_image
+from flow import STAY
+from ingest import IdempotencyStore
+from media import CHUNK_MULTIPLE, MediaTooLarge, document_id, media_items
+from metrics import metrics_from_env, state_label
+from state_store import create_state_store
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+TWILIO_ACCOUNT_SID = os.getenv('TWILIO_ACCOUNT_SID')
+TWILIO_AUTH_TOKEN = os.getenv('TWILIO_AUTH_TOKEN')
+TWILIO_WHATSAPP_NUMBER = os.getenv('TWILIO_WHATSAPP_NUMBER')
+
+MEDIA_CHUNK_SIZE = int(os.getenv('MEDIA_CHUNK_SIZE', 1024 * 1024))
+if MEDIA_CHUNK_SIZE <= 0 or MEDIA_CHUNK_SIZE % CHUNK_MULTIPLE:
+    # Blob.chunk_size would reject it on every upload, inside the workers.
+    raise ValueError(f"MEDIA_CHUNK_SIZE must be a positive multiple of {CHUNK_MULTIPLE} "
+                     f"bytes, got {MEDIA_CHUNK_SIZE}")
+MEDIA_MAX_BYTES = int(os.getenv('MEDIA_MAX_BYTES', 25 * 1024 * 1024))
+# Media larger than this is spooled to disk instead of kept in memory.
+MEDIA_SPOOL_BYTES = int(os.getenv('MEDIA_SPOOL_BYTES', 4 * 1024 * 1024))
+# Attachments of one message are fetched and uploaded in parallel.
+MEDIA_FETCH_WORKERS = int(os.getenv('MEDIA_FETCH_WORKERS', 4))
+COMPRESS_IMAGES = os.getenv('COMPRESS_IMAGES', '0') == '1'
+IMAGE_MAX_DIMENSION = int(os.getenv('IMAGE_MAX_DIMENSION', 2000))
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', 85))
+
+# How often a message is dispatched at most when it keeps losing the state
+# transition race to other messages from the same user.
+STATE_ATTEMPTS = 3
+
+metrics = metrics_from_env()
+content_stats = ContentStats()
+
+
+def state_store_from_env():
+    # Like the idempotency store, a file every worker on the node shares:
+    # consecutive messages of one conversation land on different workers.
+    # 'memory' is only right for a single worker.
+    default_url = 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'whatsapp_state.db')
+    return create_state_store(
+        os.getenv('STATE_STORE_URL', default_url),
+        ttl=int(os.getenv('STATE_TTL_SECONDS', 1800)),
+        max_entries=int(os.getenv('STATE_MAX_ENTRIES', 10000))
+    )
+
+
+def document_index_options():
+    return {
+        'ttl': int(os.getenv('DOCUMENT_CACHE_TTL_SECONDS', 300)),
+        'max_users': int(os.getenv('DOCUMENT_CACHE_MAX_USERS', 5000)),
+    }
+
+
+def ingest_queue_options():
+    max_attempts = int(os.getenv('INGEST_MAX_ATTEMPTS', 3))
+    backoff = float(os.getenv('INGEST_BACKOFF_SECONDS', 1.0))
+    # Claims are touched before every attempt, so one still pending after
+    # the longest wait in the queue or attempt, plus backoff, belongs to a
+    # worker that died with the job. Twilio retries within minutes; rows
+    # are kept for a day so resent messages are still recognised.
+    attempt_seconds = int(os.getenv('INGEST_ATTEMPT_SECONDS', 300))
+    return {
+        'workers': int(os.getenv('INGEST_WORKERS', 4)),
+        'max_depth': int(os.getenv('INGEST_QUEUE_DEPTH', 100)),
+        'max_attempts': max_attempts,
+        'backoff': backoff,
+        # A file every worker on the node shares, so a Twilio retry that
+        # lands on another worker is still recognised.
+        'seen': IdempotencyStore(
+            os.getenv('INGEST_DB_PATH',
+                      os.path.join(tempfile.gettempdir(), 'whatsapp_ingest.db')),
+            stale_after=attempt_seconds + backoff * 2 ** (max_attempts - 1),
+            retention=int(os.getenv('INGEST_SEEN_RETENTION_SECONDS', 24 * 3600)),
+        ),
+    }
+
+
+def answer(flow, state_store, trace, from_number, text, has_media, values):
+    """Run one message through `flow` and return the TwiML reply.
+
+    The state is updated with a compare-and-set. When another message from
+    the same user changed it during dispatch, a message whose transition
+    only replies is dispatched again against the new state; one that ran
+    an action keeps its replies, since the action cannot be taken back.
+    """
+    for attempt in range(1, STATE_ATTEMPTS + 1):
+        resp = MessagingResponse()
+        msg = resp.message()
+
+        with metrics.timer('state_lookup'):
+            stored_state = state_store.get(from_number)
+        state = stored_state or flow.start
+        trace.state = state_label(state)
+        with metrics.timer('dispatch', trace.state):
+            next_state = flow.dispatch(state, text, has_media, msg.body,
+                                       from_number=from_number, values=values)
+        if next_state == stored_state:
+            break
+        with metrics.timer('state_transition', trace.state):
+            if state_store.transition(from_number, stored_state, next_state):
+                break
+        if not transition_lost(from_number, stored_state, next_state, attempt,
+                               flow.acts(state, text, has_media)):
+            break
+
+    with metrics.timer('twiml_serialize'):
+        return str(resp)
+
+
+async def answer_async(flow, state_store, trace, from_number, text, has_media, values):
+    """`answer()` for engines whose actions are coroutines."""
+    for attempt in range(1, STATE_ATTEMPTS + 1):
+        resp = MessagingResponse()
+        msg = resp.message()
+
+        with metrics.timer('state_lookup'):
+            stored_state = await call_state_store(state_store, state_store.get, from_number)
+        state = stored_state or flow.start
+        trace.state = state_label(state)
+        with metrics.timer('dispatch', trace.state):
+            next_state = await flow.dispatch_async(state, text, has_media, msg.body,
+                                                   from_number=from_number, values=values)
+        if next_state == stored_state:
+            break
+        with metrics.timer('state_transition', trace.state):
+            if await call_state_store(state_store, state_store.transition,
+                                      from_number, stored_state, next_state):
+                break
+        if not transition_lost(from_number, stored_state, next_state, attempt,
+                               flow.acts(state, text, has_media)):
+            break
+
+    with metrics.timer('twiml_serialize'):
+        return str(resp)
+
+
+async def call_state_store(state_store, fn, *args):
+    # The SQLite backend does disk I/O, so keep it off the event loop.
+    if state_store.blocking:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+
+def transition_lost(from_number, expected, new, attempt, acted):
+    """Log a compare-and-set lost to another message from the same user.
+
+    Returns whether to dispatch the message again. Not after it ran an
+    action: a queued document would otherwise be answered with whatever
+    the other message's state says (e.g. the greeting menu), and its
+    replies are the ones the user needs. The other message's state stands.
+    """
+    if acted:
+        logger.warning("State of %s changed while an action ran (expected %r, wanted %r); "
+                       "keeping the other message's state", from_number, expected, new)
+        return False
+    if attempt < STATE_ATTEMPTS:
+        logger.warning("State of %s changed during dispatch (expected %r, wanted %r); "
+                       "dispatching again", from_number, expected, new)
+        return True
+    logger.warning("State of %s changed during dispatch %d times; dropping the "
+                   "transition to %r", from_number, attempt, new)
+    return False
+
+
+def new_job(turn):
+    return {
+        'message_sid': turn.values['MessageSid'],
+        'media': media_items(turn.values),
+        'doc_type': turn.state['doc_type'],
+        'from_number': turn.from_number
+    }
+
+
+def pending_media(job):
+    """The (index, media) pairs still to ingest.
+
+    Per-attachment outcomes survive retries, so a retry only repeats the
+    attachments that failed.
+    """
+    results = job.setdefault('results', {})
+    return [(i, media) for i, media in enumerate(job['media'])
+            if results.get(i) in (None, 'failed')]
+
+
+def store_media(bucket, job, media, spool, size, digest):
+    """Recompress (if enabled) and upload one downloaded attachment.
+
+    Blocking; returns the attachment's Firestore record.
+    """
+    content_type = media['content_type']
+    upload, stored = spool, size
+    if COMPRESS_IMAGES:
+        with metrics.timer('image_recompress'):
+            compressed = recompress_image(spool, content_type, IMAGE_MAX_DIMENSION, IMAGE_QUALITY)
+        if compressed:
+            upload, stored = compressed
+
+    filename = content_filename(job['doc_type'], digest, content_type)
+    blob = bucket.blob(f"documents/{filename}")
+    blob.chunk_size = MEDIA_CHUNK_SIZE
+    with metrics.timer('gcs_upload'):
+        blob.upload_from_file(upload, content_type=content_type, size=stored)
+    with metrics.timer('gcs_make_public'):
+        blob.make_public()
+    content_stats.record_stored(size, stored)
+
+    return {
+        'filename': filename,
+        'content_type': content_type,
+        'url': blob.public_url,
+        'type': job['doc_type'],
+        'user': job['from_number'],
+        'content_hash': digest,
+        'size': stored,
+        'created': time.time()
+    }
+
+
+def settle(job, pending, outcomes):
+    """Record the outcome of each pending attachment.
+
+    `outcomes` holds, per pending attachment, its record, None for a
+    duplicate, or the exception it failed with. Returns the records still
+    to be written as {index: record} and the last retryable error.
+    Attachments of one message are looked up concurrently, so identical
+    files in it are only caught here: all but the first are duplicates.
+    """
+    results = job['results']
+    records = {}
+    hashes = set()
+    error = None
+    for (i, media), outcome in zip(pending, outcomes):
+        if isinstance(outcome, BaseException) and not isinstance(outcome, Exception):
+            raise outcome
+        if isinstance(outcome, MediaTooLarge):
+            results[i] = 'too_large'
+        elif isinstance(outcome, Exception):
+            results[i] = 'failed'
+            error = outcome
+        elif outcome is None or outcome['content_hash'] in hashes:
+            results[i] = 'duplicate'
+        else:
+            hashes.add(outcome['content_hash'])
+            records[i] = outcome
+    return records, error
+
+
+def write_batch(db, job, records):
+    # Keyed on the MessageSid so a retried job overwrites instead of duplicating.
+    batch = db.batch()
+    for i, record in records.items():
+        batch.set(db.collection('documents').document(document_id(job['message_sid'], i)), record)
+    return batch
+
+
+def mark_saved(job, records):
+    for i in records:
+        job['results'][i] = 'saved'
+
+
+def reply_documents(turn, documents):
+    for document in documents:
+        turn.reply(f"{document['type']}: {document['url']}")
+
+
+def reply_document(turn, doc_type, document):
+    if document:
+        turn.reply(f"Here is your {doc_type}: {document['url']}")
+    else:
+        turn.reply(f"No {doc_type} found.")
+
+
+def reply_queued(turn, job):
+    doc_type = job['doc_type']
+    if len(job['media']) > 1:
+        turn.reply(f"{len(job['media'])} {doc_type} files received, processing. "
+                   "We'll message you once they're saved.")
+    else:
+        turn.reply(f"{doc_type} received, processing. We'll message you once it's saved.")
+
+
+def reply_already_queued(turn, job, status):
+    # Twilio retried the webhook, or the message was delivered twice.
+    doc_type = job['doc_type']
+    if status == 'done':
+        turn.reply(f"This {doc_type} message was already received and saved.")
+    elif status == 'failed':
+        turn.reply(f"We couldn't save this {doc_type} earlier. Please send it again.")
+    else:
+        turn.reply(f"{doc_type} already received, still processing. "
+                   "We'll message you once it's saved.")
+
+
+def reply_busy(turn, job):
+    turn.reply(f"We're busy right now. Please send the {job['doc_type']} again in a minute.")
+    return STAY